@@ -1,716 +1,1186 @@
-"""FastAPI server for the reservation chat bot."""
-
-import asyncio
-import logging
-import os
-import re
-from datetime import date, datetime, timedelta
-
-import uvicorn
-from dotenv import load_dotenv
-from fastapi import FastAPI, Form, Request, WebSocket, WebSocketDisconnect
-from fastapi.responses import FileResponse, JSONResponse, Response
-
-from calendar_utils import CAL_DIR, create_reservation_event, create_cancellation_reminder
-from log_utils import load_log, save_log, log_entry
-from resy_api import ResyClient, ResyBookingConflict
-from chat import ChatSession
-from sms import send_sms, send_message
-
-logging.basicConfig(level=logging.INFO)
-log = logging.getLogger(__name__)
-
-
-def _md_to_whatsapp(text: str) -> str:
-    """Convert Markdown formatting to WhatsApp-compatible plain text."""
-    # Convert markdown bullet lists:  "* item" or "- item" → "• item"
-    text = re.sub(r"^[\*\-]\s+", "• ", text, flags=re.MULTILINE)
-    # Convert bold **text** to WhatsApp bold *text*
-    text = re.sub(r"\*\*(.+?)\*\*", r"*\1*", text)
-    # Convert markdown italic _text_ — WhatsApp already supports this
-    # Convert markdown headers ## Header → *Header*
-    text = re.sub(r"^#{1,3}\s+(.+)$", r"*\1*", text, flags=re.MULTILINE)
-    return text
-
-load_dotenv()
-
-app = FastAPI()
-
-TEMPLATES_DIR = os.path.join(os.path.dirname(__file__), "templates")
-
-
-def _reconcile_log() -> list[dict]:
-    """Reconcile booked log entries against Resy's actual reservations.
-
-    Any upcoming booked entry whose confirmation_token is no longer in
-    Resy's active list gets marked as cancelled (external cancellation).
-    Returns the (possibly updated) entries list.
-    """
-    entries = load_log()
-    today_str = date.today().isoformat()
-
-    upcoming_booked = [
-        e for e in entries
-        if e and e.get("status") == "booked" and (e.get("date") or "") >= today_str
-    ]
-    if not upcoming_booked:
-        return entries
-
-    api_key = os.getenv("RESY_API_KEY")
-    auth_token = os.getenv("RESY_AUTH_TOKEN")
-    if not api_key or not auth_token:
-        return entries
-
-    try:
-        resy = ResyClient(api_key, auth_token)
-        active = resy.list_reservations()
-        active_tokens = {r["resy_token"] for r in active if r.get("resy_token")}
-    except Exception:
-        log.debug("Resy reconciliation failed, returning log as-is")
-        return entries
-
-    changed = False
-    for entry in upcoming_booked:
-        token = entry.get("confirmation_token")
-        if token and token not in active_tokens:
-            entry["status"] = "cancelled"
-            entry["source"] = "resy"
-            entry["cancelled_at"] = datetime.now().isoformat()
-            changed = True
-
-    if changed:
-        save_log(entries)
-
-    return entries
-
-
-@app.get("/")
-async def index():
-    return FileResponse(os.path.join(TEMPLATES_DIR, "index.html"))
-
-
-@app.get("/api/log")
-async def get_log():
-    entries = _reconcile_log()
-    return JSONResponse({"entries": entries, "today": date.today().isoformat()})
-
-
-@app.get("/cal/{cal_id}")
-async def get_calendar(cal_id: str):
-    """Serve a generated .ics calendar file."""
-    # Sanitize: only allow hex characters (uuid)
-    if not cal_id.replace("-", "").isalnum():
-        return Response(status_code=400)
-    filepath = os.path.join(CAL_DIR, f"{cal_id}.ics")
-    if not os.path.isfile(filepath):
-        return Response(status_code=404)
-    with open(filepath) as f:
-        content = f.read()
-    return Response(content=content, media_type="text/calendar")
-
-
-def _matches_time(slot_start: str, preferred_times: list[str]) -> bool:
-    """Check if a slot's start time matches any preferred time spec.
-
-    preferred_times entries can be:
-      "19:00"        → exact HH:MM match
-      "19:00-21:30"  → slot HH:MM is within the range (inclusive)
-    """
-    # Extract HH:MM from slot_start like "2026-03-09 19:15:00"
-    parts = slot_start.split(" ")
-    if len(parts) < 2:
-        return False
-    time_part = parts[1]  # "19:15:00"
-    hhmm_parts = time_part.split(":")
-    if len(hhmm_parts) < 2:
-        return False
-    slot_hhmm = f"{hhmm_parts[0]}:{hhmm_parts[1]}"
-
-    for pref in preferred_times:
-        if "-" in pref and pref.count("-") == 1:
-            # Range: "19:00-21:30"
-            range_start, range_end = pref.split("-")
-            if range_start.strip() <= slot_hhmm <= range_end.strip():
-                return True
-        else:
-            # Exact match
-            if slot_hhmm == pref.strip():
-                return True
-    return False
-
-
-def _auto_book(
-    resy: ResyClient,
-    config_token: str,
-    watch_date: str,
-    party_size: int,
-    venue_name: str,
-    venue_id: int,
-    match_time: str,
-    terms: dict,
-) -> tuple[bool, str, str | None, list[tuple[str, str]]]:
-    """Book a slot immediately. Returns (success, message, resy_token, calendar_events).
-
-    calendar_events is a list of (cal_id, label) tuples.
-    """
-    calendar_events: list[tuple[str, str]] = []
-
-    # 1. Fresh book_token
-    try:
-        details = resy.get_details(config_token, watch_date, party_size)
-    except Exception as e:
-        return False, f"Could not get booking details: {e}", None, []
-
-    book_token = details.get("book_token")
-    payment_method_id = details.get("payment_method_id")
-    if not book_token:
-        return False, "Slot vanished before we could book it.", None, []
-
-    # 2. Book
-    try:
-        result = resy.book(book_token, payment_method_id)
-    except ResyBookingConflict as e:
-        return False, f"Booking conflict: {e}", None, []
-    except Exception as e:
-        return False, f"Booking failed: {e}", None, []
-
-    resy_token = result.get("resy_token", "N/A")
-
-    # 3. Log
-    log_entry({
-        "status": "booked",
-        "source": "bot",
-        "venue": venue_name,
-        "venue_id": venue_id,
-        "date": watch_date,
-        "time": match_time,
-        "party_size": party_size,
-        "confirmation_token": resy_token,
-        "cancellation_policy": terms.get("cancellation_policy"),
-        "cancellation_deadline": terms.get("cancellation_deadline"),
-        "cancellation_fee": terms.get("cancellation_fee"),
-        "booked_at": datetime.now().isoformat(),
-        "created_at": datetime.now().isoformat(),
-    })
-
-    # 4. Calendar events
-    try:
-        res_cal_id = create_reservation_event(
-            venue_name=venue_name,
-            reservation_date=watch_date,
-            reservation_time=match_time,
-            party_size=party_size,
-        )
-        calendar_events.append((res_cal_id, "reservation"))
-    except Exception:
-        log.exception("Auto-book: failed to create reservation calendar event")
-
-    deadline = terms.get("cancellation_deadline")
-    if deadline:
-        try:
-            cancel_cal_id = create_cancellation_reminder(
-                venue_name=venue_name,
-                deadline_utc=deadline,
-                reservation_date=watch_date,
-                reservation_time=match_time,
-                party_size=party_size,
-            )
-            calendar_events.append((cancel_cal_id, "cancellation"))
-        except Exception:
-            log.exception("Auto-book: failed to create cancellation reminder")
-
-    msg = (
-        f"Snagged it! Booked {venue_name} on {watch_date} at {match_time} "
-        f"for {party_size}.\n\n"
-        f"Cancellation policy: {terms.get('cancellation_policy', 'N/A')}\n"
-        f"Cancel by: {terms.get('cancellation_deadline', 'N/A')}\n"
-        f"Fee: {terms.get('cancellation_fee', 'None')}"
-    )
-    return True, msg, resy_token, calendar_events
-
-
-async def run_watch(resy: ResyClient, params: dict, notify):
-    """Background task that polls for cancellations and auto-books on match.
-
-    Args:
-        resy: ResyClient instance.
-        params: Watch parameters including:
-            venue_id, venue_name, party_size, date, dates, preferred_times,
-            auto_book, terms, snipe_at (optional), base_url (optional).
-        notify: async callable(text, match=None, calendar_links=None) to deliver updates.
-    """
-    venue_id = params["venue_id"]
-    venue_name = params["venue_name"]
-    party_size = params["party_size"]
-    dates = params.get("dates", [params["date"]])
-    preferred_times = params["preferred_times"]
-    auto_book = params.get("auto_book", False)
-    terms = params.get("terms", {})
-    snipe_at_str = params.get("snipe_at")
-    base_url = params.get("base_url", "")
-
-    NORMAL_INTERVAL = 10
-    SNIPE_INTERVAL = 2
-    SNIPE_WINDOW_SECS = 5 * 60  # 5 minutes of aggressive polling
-
-    # Log the watch
-    watch_log = {
-        "status": "watching",
-        "venue": venue_name,
-        "venue_id": venue_id,
-        "date": dates[0] if dates else params["date"],
-        "dates": dates,
-        "party_size": party_size,
-        "preferred_times": preferred_times,
-        "auto_book": auto_book,
-        "terms": terms,
-        "created_at": datetime.now().isoformat(),
-    }
-    if snipe_at_str:
-        watch_log["snipe_at"] = snipe_at_str
-    log_entry(watch_log)
-
-    # Unique key for this watch entry in the log
-    watch_created_at = watch_log["created_at"]
-
-    def _update_watch(updates: dict):
-        """Update this watch entry in the log by created_at."""
-        entries = load_log()
-        for e in entries:
-            if e and e.get("created_at") == watch_created_at and e.get("status") == "watching":
-                e.update(updates)
-                break
-        save_log(entries)
-
-    def _all_dates_passed() -> bool:
-        today = datetime.now().date()
-        return all(
-            today > datetime.fromisoformat(d).date()
-            for d in dates
-        )
-
-    # --- Snipe mode: sleep until snipe window ---
-    if snipe_at_str:
-        try:
-            snipe_at = datetime.fromisoformat(snipe_at_str)
-        except ValueError:
-            snipe_at = None
-
-        if snipe_at:
-            wake_at = snipe_at - timedelta(seconds=30)
-            while datetime.now() < wake_at:
-                # Sleep in 10-second chunks for cancellation responsiveness
-                remaining = (wake_at - datetime.now()).total_seconds()
-                await asyncio.sleep(min(10, max(0.5, remaining)))
-
-    try:
-        snipe_start = datetime.now() if snipe_at_str else None
-
-        while True:
-            if _all_dates_passed():
-                _update_watch({"status": "expired", "expired_at": datetime.now().isoformat()})
-                try:
-                    await notify(
-                        f"Watch expired: {venue_name} — all watched dates have passed. "
-                        f"No slots opened up. Stopping watch."
-                    )
-                except Exception:
-                    pass
-                return
-
-            # Determine poll interval
-            poll_interval = NORMAL_INTERVAL
-            if snipe_start:
-                elapsed = (datetime.now() - snipe_start).total_seconds()
-                if elapsed < SNIPE_WINDOW_SECS:
-                    poll_interval = SNIPE_INTERVAL
-
-            await asyncio.sleep(poll_interval)
-            now_str = datetime.now().strftime("%H:%M:%S")
-
-            if _all_dates_passed():
-                _update_watch({"status": "expired", "expired_at": datetime.now().isoformat()})
-                try:
-                    await notify(
-                        f"Watch expired: {venue_name} — all watched dates have passed. "
-                        f"No slots opened up. Stopping watch."
-                    )
-                except Exception:
-                    pass
-                return
-
-            # Poll each date
-            for watch_date in dates:
-                # Skip dates that have passed
-                if datetime.now().date() > datetime.fromisoformat(watch_date).date():
-                    continue
-
-                try:
-                    slots = resy.find_slots(venue_id, party_size, watch_date)
-                except Exception as e:
-                    try:
-                        await notify(f"[{now_str}] Poll error for {watch_date}: {e}")
-                    except Exception:
-                        return
-                    continue
-
-                # Check for a match
-                matched_slot = None
-                for slot in slots:
-                    start = slot.get("date", {}).get("start", "")
-                    if _matches_time(start, preferred_times):
-                        matched_slot = slot
-                        break
-
-                if not matched_slot:
-                    continue
-
-                match_time = matched_slot.get("date", {}).get("start", "unknown")
-                config_token = matched_slot.get("config", {}).get("token", "")
-
-                if auto_book:
-                    # Auto-book immediately
-                    success, msg, resy_token, cal_events = _auto_book(
-                        resy, config_token, watch_date, party_size,
-                        venue_name, venue_id, match_time, terms,
-                    )
-
-                    # Build calendar links
-                    cal_links = []
-                    if base_url:
-                        for cal_id, label in cal_events:
-                            cal_links.append({
-                                "url": f"{base_url}/cal/{cal_id}",
-                                "cal_id": cal_id,
-                                "label": label,
-                            })
-
-                    if success:
-                        _update_watch({
-                            "status": "booked",
-                            "booked_at": datetime.now().isoformat(),
-                            "booked_time": match_time,
-                            "booked_date": watch_date,
-                        })
-                        try:
-                            await notify(msg, calendar_links=cal_links)
-                        except Exception:
-                            pass
-                        return  # Done — watch fulfilled
-                    else:
-                        # Check if it was a booking conflict (412)
-                        is_conflict = "conflict" in msg.lower()
-                        try:
-                            await notify(
-                                f"[{now_str}] Auto-book failed: {msg}"
-                                + (" Continuing to watch..." if is_conflict else " Retrying next cycle..."),
-                            )
-                        except Exception:
-                            return
-                        # Continue watching regardless of error type
-                        continue
-                else:
-                    # Legacy notify-only mode (shouldn't happen with new flow, but safe fallback)
-                    match_info = {
-                        "time": match_time,
-                        "config_token": config_token,
-                        "venue_name": venue_name,
-                        "venue_id": venue_id,
-                        "date": watch_date,
-                        "party_size": party_size,
-                    }
-                    try:
-                        await notify(
-                            f"[{now_str}] Match found: {match_time}!",
-                            match=match_info,
-                        )
-                    except Exception:
-                        return
-
-    except asyncio.CancelledError:
-        _update_watch({"status": "stopped", "stopped_at": datetime.now().isoformat()})
-
-
-@app.websocket("/ws")
-async def websocket_endpoint(ws: WebSocket):
-    await ws.accept()
-
-    api_key = os.getenv("RESY_API_KEY")
-    auth_token = os.getenv("RESY_AUTH_TOKEN")
-
-    if not api_key or not auth_token:
-        await ws.send_json({
-            "type": "bot_message",
-            "text": "Error: RESY_API_KEY and RESY_AUTH_TOKEN must be set in .env",
-        })
-        await ws.close()
-        return
-
-    resy = ResyClient(api_key, auth_token)
-    session = ChatSession(resy)
-    watch_tasks: list[asyncio.Task] = []
-
-    async def ws_notify(text: str, match=None, calendar_links=None):
-        payload = {"type": "watch_update", "text": text}
-        if match is not None:
-            payload["match"] = match
-        if calendar_links:
-            payload["calendar_links"] = calendar_links
-        await ws.send_json(payload)
-
-    try:
-        while True:
-            data = await ws.receive_json()
-
-            if data.get("type") == "message":
-                user_text = data.get("text", "").strip()
-                if not user_text:
-                    continue
-
-                # Send typing indicator
-                await ws.send_json({"type": "typing", "text": ""})
-
-                try:
-                    events = await session.process_message(user_text)
-                except Exception as e:
-                    log.exception("WebSocket process_message failed, resetting session")
-                    session = ChatSession(resy)
-                    await ws.send_json({
-                        "type": "bot_message",
-                        "text": "Sorry, something went wrong. Please try again.",
-                    })
-                    continue
-
-                for event in events:
-                    if event["type"] == "text":
-                        await ws.send_json({
-                            "type": "bot_message",
-                            "text": event["text"],
-                        })
-                    elif event["type"] == "watch":
-                        watch_params = event["params"]
-                        # WebSocket doesn't have a base_url from request,
-                        # so calendar links use relative paths via /cal/{id}
-                        watch_params["base_url"] = ""
-                        task = asyncio.create_task(
-                            run_watch(resy, watch_params, ws_notify)
-                        )
-                        watch_tasks.append(task)
-                        await ws.send_json({
-                            "type": "bot_message",
-                            "text": "Watch armed with auto-book! I'll book instantly when a match opens up.",
-                        })
-                    elif event["type"] == "calendar":
-                        await ws.send_json({
-                            "type": "calendar_link",
-                            "url": f"/cal/{event['cal_id']}",
-                            "label": event.get("label", "reservation"),
-                        })
-
-    except WebSocketDisconnect:
-        pass
-    finally:
-        for task in watch_tasks:
-            task.cancel()
-
-
-# ---------------------------------------------------------------------------
-# Twilio webhooks (WhatsApp + SMS)
-# ---------------------------------------------------------------------------
-
-# Per-channel state: each channel gets its own ChatSession so conversations
-# don't bleed across WhatsApp and SMS.
-_channel_state: dict[str, dict] = {}  # channel → {"resy", "session", "watch_tasks"}
-
-
-def _get_channel_state(channel: str) -> dict:
-    """Lazily initialize per-channel ResyClient, ChatSession, and watch tasks."""
-    if channel not in _channel_state:
-        api_key = os.getenv("RESY_API_KEY")
-        auth_token = os.getenv("RESY_AUTH_TOKEN")
-        if not api_key or not auth_token:
-            raise RuntimeError("RESY_API_KEY and RESY_AUTH_TOKEN must be set in .env")
-        resy = ResyClient(api_key, auth_token)
-        _channel_state[channel] = {
-            "resy": resy,
-            "session": ChatSession(resy),
-            "watch_tasks": [],
-        }
-    return _channel_state[channel]
-
-
-async def _handle_twilio_message(request: Request, channel: str):
-    """Shared handler for both WhatsApp and SMS webhooks."""
-    form = await request.form()
-    body = (form.get("Body") or "").strip()
-    from_number = form.get("From", "")
-
-    if not body:
-        return Response(status_code=200)
-
-    def _reply(text: str):
-        try:
-            send_message(text, to=from_number, channel=channel)
-        except Exception as e:
-            log.error("Failed to send %s to %s: %s", channel, from_number, e)
-
-    try:
-        state = _get_channel_state(channel)
-    except RuntimeError as e:
-        _reply(str(e))
-        return Response(status_code=200)
-
-    resy_client = state["resy"]
-    session = state["session"]
-    watch_tasks = state["watch_tasks"]
-
-    # Prune finished tasks
-    watch_tasks[:] = [t for t in watch_tasks if not t.done()]
-
-    # Handle special commands
-    lower = body.lower().strip()
-    _is_status_cmd = (
-        lower in ("log", "status", "dashboard", "my watches", "my reservations", "my bookings")
-        or re.search(r"\b(show|view|get|check)\b.+\b(log|status|reservations|watches|bookings|dashboard)\b", lower)
-        or re.search(r"\b(my|the)\s+(log|status|reservations|watches|bookings)\b", lower)
-    )
-    if _is_status_cmd:
-        entries = _reconcile_log()
-        today_str = date.today().isoformat()
-        watching = [e for e in entries if e and e.get("status") == "watching"
-                    and (e.get("date") or "") >= today_str]
-        watch_booked = [e for e in entries if e and e.get("status") == "booked"
-                        and e.get("auto_book")]
-        booked = [e for e in entries if e and e.get("status") == "booked"]
-        cancelled = [e for e in entries if e and e.get("status") == "cancelled"]
-        upcoming = [e for e in booked if (e.get("date") or "") >= today_str]
-        past = [e for e in booked if (e.get("date") or "") < today_str]
-
-        lines = []
-        if watching:
-            lines.append("Active watches:")
-            for e in watching:
-                times = ", ".join(e.get("preferred_times", []))
-                lines.append(f"- {e.get('venue', '?')} on {e.get('date', '?')} for {e.get('party_size', '?')} ({times})")
-
-        if upcoming:
-            lines.append("\nUpcoming reservations:")
-            for e in upcoming:
-                line = f"- {e.get('venue', '?')} on {e.get('date', '?')} at {e.get('time', '?')} for {e.get('party_size', '?')}"
-                deadline = e.get("cancellation_deadline")
-                if deadline:
-                    line += f"\n  Cancel by: {deadline}"
-                    fee = e.get("cancellation_fee")
-                    if fee:
-                        line += f" (fee: {fee})"
-                lines.append(line)
-
-        if past:
-            lines.append("\nPast reservations:")
-            for e in past:
-                lines.append(f"- {e.get('venue', '?')} on {e.get('date', '?')} at {e.get('time', '?')}")
-
-        if cancelled:
-            lines.append("\nCancelled:")
-            for e in cancelled:
-                source = "via bot" if e.get("source") == "bot" else "on Resy"
-                line = f"- {e.get('venue', '?')} on {e.get('date', '?')}"
-                if e.get("cancelled_at"):
-                    line += f" (cancelled {e['cancelled_at'][:10]}, {source})"
-                else:
-                    line += f" ({source})"
-                lines.append(line)
-
-        if not lines:
-            lines.append("No watches or reservations yet.")
-
-        _reply("\n".join(lines))
-        return Response(status_code=200)
-
-    if lower in ("stop watching", "cancel watch", "stop watch", "cancel watching"):
-        if watch_tasks:
-            for t in watch_tasks:
-                t.cancel()
-            watch_tasks.clear()
-            _reply("All watches cancelled.")
-        else:
-            _reply("No active watches to cancel.")
-        return Response(status_code=200)
-
-    # Process message through ChatSession
-    try:
-        events = await session.process_message(body)
-    except Exception:
-        log.exception("%s process_message failed, resetting session", channel)
-        state["session"] = ChatSession(resy_client)
-        try:
-            _reply("Sorry, something went wrong. Please try again.")
-        except Exception:
-            pass
-        return Response(status_code=200)
-
-    base_url = str(request.base_url).rstrip("/")
-
-    # Consolidate all text events into a single message
-    text_parts: list[str] = []
-    for event in events:
-        if event["type"] == "text":
-            text_parts.append(event["text"])
-        elif event["type"] == "watch":
-            _ch = channel
-            _to = from_number
-            _base = base_url
-
-            async def _notify(text: str, match=None, calendar_links=None, _channel=_ch, _dest=_to, _bu=_base):
-                msg = text
-                if match:
-                    msg += (
-                        f"\n\nMatch: {match['venue_name']} on {match['date']}"
-                        f" at {match['time']} for {match['party_size']}."
-                    )
-                if calendar_links:
-                    for cl in calendar_links:
-                        label = cl.get("label", "reservation")
-                        url = cl.get("url", "")
-                        if label == "cancellation":
-                            msg += f"\n\nAdd cancellation deadline reminder to your calendar: {url}"
-                        else:
-                            msg += f"\n\nAdd reservation to your calendar: {url}"
-                send_message(msg, to=_dest, channel=_channel)
-
-            watch_params = event["params"]
-            watch_params["base_url"] = base_url
-            task = asyncio.create_task(
-                run_watch(resy_client, watch_params, _notify)
-            )
-            watch_tasks.append(task)
-            text_parts.append("Watch armed with auto-book! I'll book instantly when a match opens up.")
-        elif event["type"] == "calendar":
-            cal_url = f"{base_url}/cal/{event['cal_id']}"
-            label = event.get("label", "reservation")
-            if label == "cancellation":
-                text_parts.append(f"Add cancellation deadline reminder to your calendar: {cal_url}")
-            else:
-                text_parts.append(f"Add reservation to your calendar: {cal_url}")
-
-    if text_parts:
-        combined = "\n\n".join(text_parts)
-        if channel == "whatsapp":
-            combined = _md_to_whatsapp(combined)
-        _reply(combined)
-
-    return Response(status_code=200)
-
-
-@app.post("/whatsapp")
-async def whatsapp_webhook(request: Request):
-    return await _handle_twilio_message(request, channel="whatsapp")
-
-
-@app.post("/sms")
-async def sms_webhook(request: Request):
-    return await _handle_twilio_message(request, channel="sms")
-
-
-if __name__ == "__main__":
-    uvicorn.run("app:app", host="0.0.0.0", port=8080, reload=True)
+"""FastAPI server for the reservation chat bot."""
+
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+from datetime import date, datetime, timedelta
+
+import orjson
+import uvicorn
+from dotenv import load_dotenv
+from fastapi import FastAPI, Form, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import FileResponse, Response
+
+from calendar_utils import CAL_DIR, create_reservation_event, create_cancellation_reminder
+from log_utils import flush_pending, load_log_async, log_entry_async, update_entry_async
+from resy_api import ResyClient, ResyBookingConflict
+from chat import ChatSession
+from sms import send_sms, send_message
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
+
+
+def _md_to_whatsapp(text: str) -> str:
+    """Convert Markdown formatting to WhatsApp-compatible plain text."""
+    # Convert markdown bullet lists:  "* item" or "- item" → "• item"
+    text = re.sub(r"^[\*\-]\s+", "• ", text, flags=re.MULTILINE)
+    # Convert bold **text** to WhatsApp bold *text*
+    text = re.sub(r"\*\*(.+?)\*\*", r"*\1*", text)
+    # Convert markdown italic _text_ — WhatsApp already supports this
+    # Convert markdown headers ## Header → *Header*
+    text = re.sub(r"^#{1,3}\s+(.+)$", r"*\1*", text, flags=re.MULTILINE)
+    return text
+
+load_dotenv()
+
+# Nagle's algorithm is already off for every connection: asyncio sets
+# TCP_NODELAY on each accepted TCP transport by default, and uvloop has
+# done the same since 0.8.1 — small frames (typing indicators, watch
+# updates) go out immediately under both loops.
+app = FastAPI()
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(__file__), "templates")
+
+
+@app.on_event("shutdown")
+async def _drain_log() -> None:
+    # Log appends are debounced; drain anything still pending so a clean
+    # shutdown doesn't drop the last ~0.5s of entries.
+    await flush_pending()
+
+
+_resy_client: ResyClient | None = None
+
+
+def _get_resy() -> ResyClient:
+    """Shared ResyClient for log reconciliation and the Twilio channels."""
+    global _resy_client
+    if _resy_client is None:
+        api_key = os.getenv("RESY_API_KEY")
+        auth_token = os.getenv("RESY_AUTH_TOKEN")
+        if not api_key or not auth_token:
+            raise RuntimeError("RESY_API_KEY and RESY_AUTH_TOKEN must be set in .env")
+        _resy_client = ResyClient(api_key, auth_token)
+    return _resy_client
+
+
+async def _reconcile_log() -> list[dict]:
+    """Reconcile booked log entries against Resy's actual reservations.
+
+    Any upcoming booked entry whose confirmation_token is no longer in
+    Resy's active list gets marked as cancelled (external cancellation).
+    Returns the (possibly updated) entries list.
+    """
+    entries = await load_log_async()
+    today_str = date.today().isoformat()
+
+    upcoming_booked = [
+        e for e in entries
+        if e and e.get("status") == "booked" and (e.get("date") or "") >= today_str
+    ]
+    if not upcoming_booked:
+        return entries
+
+    try:
+        resy = _get_resy()
+        active = await resy.list_reservations()
+        active_tokens = {r["resy_token"] for r in active if r.get("resy_token")}
+    except Exception:
+        log.debug("Resy reconciliation failed, returning log as-is")
+        return entries
+
+    for entry in upcoming_booked:
+        token = entry.get("confirmation_token")
+        if token and token not in active_tokens:
+            await update_entry_async(entry["created_at"], {
+                "status": "cancelled",
+                "source": "resy",
+                "cancelled_at": datetime.now().isoformat(),
+            })
+
+    return entries
+
+
+@app.get("/")
+async def index():
+    return FileResponse(os.path.join(TEMPLATES_DIR, "index.html"))
+
+
+@app.get("/api/log")
+async def get_log():
+    entries = await _reconcile_log()
+    # Already a list of plain dicts — skip FastAPI's jsonable_encoder pass
+    return Response(
+        orjson.dumps({"entries": entries, "today": date.today().isoformat()}),
+        media_type="application/json",
+    )
+
+
+@app.get("/cal/{cal_id}")
+async def get_calendar(cal_id: str):
+    """Serve a generated .ics calendar file."""
+    # Sanitize: only allow hex characters (uuid)
+    if not cal_id.replace("-", "").isalnum():
+        return Response(status_code=400)
+    filepath = os.path.join(CAL_DIR, f"{cal_id}.ics")
+    if not os.path.isfile(filepath):
+        return Response(status_code=404)
+    with open(filepath) as f:
+        content = f.read()
+    return Response(content=content, media_type="text/calendar")
+
+
+def _compile_preferred_times(
+    preferred_times: list[str],
+) -> tuple[frozenset[str], tuple[tuple[str, str], ...]]:
+    """Pre-parse preferred time specs so the per-slot check is a set probe.
+
+    preferred_times entries can be:
+      "19:00"        → exact HH:MM match
+      "19:00-21:30"  → slot HH:MM is within the range (inclusive)
+
+    Returns (exact HH:MM strings, (range_start, range_end) pairs).
+    """
+    exact = set()
+    ranges = []
+    for pref in preferred_times:
+        pref = pref.strip()
+        if "-" in pref and pref.count("-") == 1:
+            range_start, range_end = pref.split("-")
+            ranges.append((range_start.strip(), range_end.strip()))
+        else:
+            exact.add(pref)
+    return frozenset(exact), tuple(ranges)
+
+
+def _matches_time(
+    slot_start: str,
+    exact: frozenset[str],
+    ranges: tuple[tuple[str, str], ...],
+) -> bool:
+    """Check a slot start ("YYYY-MM-DD HH:MM:SS") against compiled prefs."""
+    slot_hhmm = slot_start[11:16]  # "19:15"
+    if slot_hhmm in exact:
+        return True
+    return any(lo <= slot_hhmm <= hi for lo, hi in ranges)
+
+
+async def _auto_book(
+    resy: ResyClient,
+    config_token: str,
+    watch_date: str,
+    party_size: int,
+    venue_name: str,
+    venue_id: int,
+    match_time: str,
+    terms: dict,
+) -> tuple[bool, str, str | None, list[tuple[str, str]]]:
+    """Book a slot immediately. Returns (success, message, resy_token, calendar_events).
+
+    calendar_events is a list of (cal_id, label) tuples.
+    """
+    calendar_events: list[tuple[str, str]] = []
+
+    # 1. Fresh book_token
+    try:
+        details = await resy.get_details(config_token, watch_date, party_size)
+    except Exception as e:
+        return False, f"Could not get booking details: {e}", None, []
+
+    book_token = details.get("book_token")
+    payment_method_id = details.get("payment_method_id")
+    if not book_token:
+        return False, "Slot vanished before we could book it.", None, []
+
+    # 2. Book
+    try:
+        result = await resy.book(book_token, payment_method_id)
+    except ResyBookingConflict as e:
+        return False, f"Booking conflict: {e}", None, []
+    except Exception as e:
+        return False, f"Booking failed: {e}", None, []
+
+    resy_token = result.get("resy_token", "N/A")
+
+    # 3. Log
+    booked_iso = datetime.now().isoformat()
+    await log_entry_async({
+        "status": "booked",
+        "source": "bot",
+        "venue": venue_name,
+        "venue_id": venue_id,
+        "date": watch_date,
+        "time": match_time,
+        "party_size": party_size,
+        "confirmation_token": resy_token,
+        "cancellation_policy": terms.get("cancellation_policy"),
+        "cancellation_deadline": terms.get("cancellation_deadline"),
+        "cancellation_fee": terms.get("cancellation_fee"),
+        "booked_at": booked_iso,
+        "created_at": booked_iso,
+    })
+
+    # 4. Calendar events
+    try:
+        res_cal_id = create_reservation_event(
+            venue_name=venue_name,
+            reservation_date=watch_date,
+            reservation_time=match_time,
+            party_size=party_size,
+        )
+        calendar_events.append((res_cal_id, "reservation"))
+    except Exception:
+        log.exception("Auto-book: failed to create reservation calendar event")
+
+    deadline = terms.get("cancellation_deadline")
+    if deadline:
+        try:
+            cancel_cal_id = create_cancellation_reminder(
+                venue_name=venue_name,
+                deadline_utc=deadline,
+                reservation_date=watch_date,
+                reservation_time=match_time,
+                party_size=party_size,
+            )
+            calendar_events.append((cancel_cal_id, "cancellation"))
+        except Exception:
+            log.exception("Auto-book: failed to create cancellation reminder")
+
+    msg = (
+        f"Snagged it! Booked {venue_name} on {watch_date} at {match_time} "
+        f"for {party_size}.\n\n"
+        f"Cancellation policy: {terms.get('cancellation_policy', 'N/A')}\n"
+        f"Cancel by: {terms.get('cancellation_deadline', 'N/A')}\n"
+        f"Fee: {terms.get('cancellation_fee', 'None')}"
+    )
+    return True, msg, resy_token, calendar_events
+
+
+def _fmt_hms(t: datetime) -> str:
+    """Format HH:MM:SS without strftime's format-string parsing overhead."""
+    return f"{t.hour:02d}:{t.minute:02d}:{t.second:02d}"
+
+
+def _parse_snipe_at(snipe_at_str: str | None) -> datetime | None:
+    if not snipe_at_str:
+        return None
+    try:
+        return datetime.fromisoformat(snipe_at_str)
+    except ValueError:
+        return None
+
+
+class _Watch:
+    """A single registered watch: user parameters plus scheduling state."""
+
+    def __init__(self, watch_id: int, resy: ResyClient, params: dict, notify,
+                 owner: str | None = None):
+        self.id = watch_id
+        self.resy = resy
+        self.notify = notify
+        self.owner = owner
+        self.venue_id = params["venue_id"]
+        self.venue_name = params["venue_name"]
+        self.party_size = params["party_size"]
+        self.dates = params.get("dates", [params["date"]])
+        self.preferred_times = params["preferred_times"]
+        # Parse the time specs once — the per-poll scan is then a set probe
+        # per slot instead of re-splitting every pref string per slot.
+        self.exact_times, self.time_ranges = _compile_preferred_times(self.preferred_times)
+        self.auto_book = params.get("auto_book", False)
+        self.terms = params.get("terms", {})
+        self.base_url = params.get("base_url", "")
+        self.snipe_at = _parse_snipe_at(params.get("snipe_at"))
+        self.snipe_started: datetime | None = None
+        # date → slot-start set from the last poll, so non-match updates
+        # only go out when availability actually changes
+        self.last_available: dict[str, frozenset[str]] = {}
+        self.failures = 0  # consecutive poll errors → exponential backoff
+        self.unchanged_polls = 0  # consecutive polls with an identical slot set
+        self.created_at = datetime.now().isoformat()
+        self.next_poll_at = datetime.now()
+
+    def poll_interval(self, now: datetime) -> float:
+        if self.snipe_started:
+            elapsed = (now - self.snipe_started).total_seconds()
+            if elapsed < WatchRegistry.SNIPE_WINDOW_SECS:
+                return WatchRegistry.SNIPE_INTERVAL
+
+        # Tier by how far out the nearest watched date is — availability
+        # a week away barely moves, while the final half hour matters
+        # second to second.
+        active = self.active_dates(now.date())
+        delta = (
+            (datetime.fromisoformat(min(active)) - now).total_seconds()
+            if active else 0
+        )
+        if delta > 24 * 3600:
+            interval = WatchRegistry.FAR_INTERVAL
+        elif delta > 2 * 3600:
+            interval = WatchRegistry.DAY_INTERVAL
+        elif delta > 30 * 60:
+            interval = WatchRegistry.NEAR_INTERVAL
+        else:
+            interval = WatchRegistry.NORMAL_INTERVAL
+
+        # A stagnant slot set earns a slower cadence, and poll errors back
+        # off exponentially so a Resy outage isn't hammered every cycle.
+        if self.unchanged_polls >= WatchRegistry.UNCHANGED_THRESHOLD:
+            interval = min(interval * 2, WatchRegistry.FAR_INTERVAL)
+        if self.failures:
+            interval = min(
+                interval * (2 ** self.failures), WatchRegistry.ERROR_BACKOFF_CAP,
+            )
+        return interval
+
+    def due(self, now: datetime) -> bool:
+        # Snipe mode: stay dormant until 30s before the release time
+        if self.snipe_at:
+            wake_at = self.snipe_at - timedelta(seconds=30)
+            if now < wake_at:
+                return False
+            if self.snipe_started is None:
+                self.snipe_started = now
+        return now >= self.next_poll_at
+
+    def active_dates(self, today) -> list[str]:
+        return [
+            d for d in self.dates
+            if today <= datetime.fromisoformat(d).date()
+        ]
+
+
+class WatchLimitError(Exception):
+    """Raised when a new watch would exceed the global capacity."""
+
+
+class WatchRegistry:
+    """Registry of active watches, polled by one shared scheduler task.
+
+    Instead of one long-lived task with its own sleep timer per watch, a
+    single coroutine wakes every TICK seconds, groups the watches that are
+    due by (venue_id, party_size, date), and issues one find_slots call
+    per group, fanning the slots out to each watch. N watches on the same
+    venue and date cost one HTTP request per poll instead of N.
+    """
+
+    # Adaptive poll tiers, by time until the nearest watched date
+    NORMAL_INTERVAL = 10  # within 30 minutes
+    NEAR_INTERVAL = 20  # within 2 hours
+    DAY_INTERVAL = 60  # within 24 hours
+    FAR_INTERVAL = 300  # more than a day out
+    UNCHANGED_THRESHOLD = 10  # identical polls before slowing the cadence
+    ERROR_BACKOFF_CAP = 600  # ceiling for exponential error backoff
+    MAX_WATCHES = 200  # global cap on concurrent watches
+    SNIPE_INTERVAL = 2
+    SNIPE_WINDOW_SECS = 5 * 60  # 5 minutes of aggressive polling
+    TICK = 2  # scheduler granularity (= smallest poll interval)
+    SLOTS_TTL = 5  # seconds — normal-cadence polls may reuse a fresh result
+
+    def __init__(self):
+        self._watches: dict[int, _Watch] = {}
+        self._next_id = 1
+        self._task: asyncio.Task | None = None
+        # key → (monotonic timestamp, slots). Snipe-window polls bypass the
+        # TTL so they always see fresh data.
+        self._slots_cache: dict[tuple[int, int, str], tuple[float, list]] = {}
+        # key → in-flight find_slots future, so a fetch that outlives a tick
+        # is shared rather than duplicated (singleflight)
+        self._inflight: dict[tuple[int, int, str], asyncio.Future] = {}
+
+    async def add(self, resy: ResyClient, params: dict, notify,
+                  owner: str | None = None) -> int:
+        """Register a watch and return its id.
+
+        Args:
+            resy: ResyClient instance.
+            params: Watch parameters including:
+                venue_id, venue_name, party_size, date, dates, preferred_times,
+                auto_book, terms, snipe_at (optional), base_url (optional).
+            notify: async callable(text, match=None, calendar_links=None)
+                to deliver updates.
+            owner: optional key grouping watches for bulk cancellation.
+
+        Raises:
+            WatchLimitError: If the server is already at MAX_WATCHES.
+            ValueError: If any watch date is not a valid ISO date.
+        """
+        if len(self._watches) >= self.MAX_WATCHES:
+            raise WatchLimitError(
+                f"server is at capacity ({self.MAX_WATCHES} active watches)"
+            )
+        # Dates come from the LLM — reject anything fromisoformat can't
+        # parse here, before the watch enters the shared scheduler, where
+        # a malformed date would raise on every tick.
+        for watch_date in params.get("dates", [params["date"]]):
+            try:
+                datetime.fromisoformat(watch_date)
+            except (TypeError, ValueError):
+                raise ValueError(
+                    f"invalid watch date {watch_date!r} (expected YYYY-MM-DD)"
+                )
+        watch = _Watch(self._next_id, resy, params, notify, owner=owner)
+        self._next_id += 1
+        self._watches[watch.id] = watch
+
+        watch_log = {
+            "status": "watching",
+            "venue": watch.venue_name,
+            "venue_id": watch.venue_id,
+            "date": watch.dates[0] if watch.dates else params["date"],
+            "dates": watch.dates,
+            "party_size": watch.party_size,
+            "preferred_times": watch.preferred_times,
+            "auto_book": watch.auto_book,
+            "terms": watch.terms,
+            "created_at": watch.created_at,
+        }
+        if params.get("snipe_at"):
+            watch_log["snipe_at"] = params["snipe_at"]
+        await log_entry_async(watch_log)
+
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._scheduler())
+        return watch.id
+
+    def active(self, watch_id: int) -> bool:
+        return watch_id in self._watches
+
+    def remove(self, watch_id: int) -> None:
+        """Stop a watch (user cancellation or client disconnect)."""
+        watch = self._watches.pop(watch_id, None)
+        if watch:
+            asyncio.create_task(update_entry_async(
+                watch.created_at,
+                {"status": "stopped", "stopped_at": datetime.now().isoformat()},
+            ))
+
+    def remove_owner(self, owner: str) -> int:
+        """Stop all watches registered under an owner key."""
+        ids = [w.id for w in self._watches.values() if w.owner == owner]
+        for watch_id in ids:
+            self.remove(watch_id)
+        return len(ids)
+
+    async def _finish(self, watch: _Watch, updates: dict, message: str | None = None):
+        """Remove a watch that reached a terminal state and update the log."""
+        self._watches.pop(watch.id, None)
+        await update_entry_async(watch.created_at, updates)
+        if message:
+            try:
+                await watch.notify(message)
+            except Exception:
+                pass
+
+    async def _scheduler(self):
+        """Shared poll loop — runs while any watch is registered."""
+        while self._watches:
+            await asyncio.sleep(self.TICK)
+            now = datetime.now()
+            today = now.date()
+
+            # Expire watches whose dates have all passed. Each watch is
+            # guarded individually: the shared loop polls for everyone, so
+            # one broken watch must be dropped, not allowed to raise out
+            # of the scheduler and silently stop polling for the rest.
+            for watch in list(self._watches.values()):
+                try:
+                    expired = not watch.active_dates(today)
+                except Exception:
+                    log.exception("Dropping broken watch %d (%s)", watch.id, watch.venue_name)
+                    await self._finish(
+                        watch,
+                        {"status": "stopped", "stopped_at": datetime.now().isoformat()},
+                        f"Watch stopped: {watch.venue_name} — internal error. "
+                        f"Please arm it again.",
+                    )
+                    continue
+                if expired:
+                    await self._finish(
+                        watch,
+                        {"status": "expired", "expired_at": datetime.now().isoformat()},
+                        f"Watch expired: {watch.venue_name} — all watched dates have passed. "
+                        f"No slots opened up. Stopping watch.",
+                    )
+
+            due = [w for w in self._watches.values() if w.due(now)]
+            if not due:
+                continue
+
+            # One find_slots per distinct (venue_id, party_size, date)
+            groups: dict[tuple[int, int, str], list[_Watch]] = {}
+            group_min_interval: dict[tuple[int, int, str], float] = {}
+            for watch in due:
+                interval = watch.poll_interval(now)
+                watch.next_poll_at = now + timedelta(seconds=interval)
+                for watch_date in watch.active_dates(today):
+                    key = (watch.venue_id, watch.party_size, watch_date)
+                    groups.setdefault(key, []).append(watch)
+                    group_min_interval[key] = min(
+                        group_min_interval.get(key, interval), interval,
+                    )
+
+            # Serve normal-cadence groups from the short-TTL cache; fetch
+            # the rest (one shared in-flight call per key)
+            now_mono = time.monotonic()
+            served: dict[tuple[int, int, str], list] = {}
+            fetch_keys = []
+            for key, group in groups.items():
+                cached = self._slots_cache.get(key)
+                if (
+                    group_min_interval[key] > self.SNIPE_INTERVAL
+                    and cached
+                    and now_mono - cached[0] < self.SLOTS_TTL
+                ):
+                    served[key] = cached[1]
+                else:
+                    fetch_keys.append(key)
+
+            results = await asyncio.gather(
+                *(self._fetch_slots(groups[key][0].resy, key) for key in fetch_keys),
+                return_exceptions=True,
+            )
+            for key, result in zip(fetch_keys, results):
+                if not isinstance(result, BaseException):
+                    self._slots_cache[key] = (time.monotonic(), result)
+                served[key] = result
+
+            # A multi-date watch appears under one group key per date, so
+            # backoff counters are aggregated here and applied once per
+            # watch per tick — not once per date, which would grow the
+            # error backoff by 2^(n_dates) and hit UNCHANGED_THRESHOLD
+            # n_dates times too fast.
+            now_str = _fmt_hms(now)
+            tick_failed: set[int] = set()
+            tick_polled: set[int] = set()
+            tick_changed: set[int] = set()
+            for key, result in served.items():
+                watch_date = key[2]
+                for watch in groups[key]:
+                    if watch.id not in self._watches:
+                        continue  # finished earlier this tick
+                    if isinstance(result, BaseException):
+                        tick_failed.add(watch.id)
+                        try:
+                            await watch.notify(f"[{now_str}] Poll error for {watch_date}: {result}")
+                        except Exception:
+                            self.remove(watch.id)
+                        continue
+                    tick_polled.add(watch.id)
+                    try:
+                        if await self._deliver(watch, watch_date, result, now_str):
+                            tick_changed.add(watch.id)
+                    except Exception:
+                        log.exception(
+                            "Watch %d delivery failed for %s", watch.id, watch_date
+                        )
+
+            for watch_id in tick_failed:
+                watch = self._watches.get(watch_id)
+                if watch is not None:
+                    watch.failures += 1
+            for watch_id in tick_polled - tick_failed:
+                watch = self._watches.get(watch_id)
+                if watch is None:
+                    continue  # booked/finished during delivery
+                watch.failures = 0
+                if watch_id in tick_changed:
+                    watch.unchanged_polls = 0
+                else:
+                    watch.unchanged_polls += 1
+
+            # Drop cache entries for keys no longer being polled
+            if len(self._slots_cache) > len(groups) * 2:
+                self._slots_cache = {
+                    k: v for k, v in self._slots_cache.items() if k in groups
+                }
+
+    def _fetch_slots(self, resy: ResyClient, key: tuple[int, int, str]) -> asyncio.Future:
+        """Start (or join) the single in-flight find_slots call for a key."""
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(
+                resy.find_slots(key[0], key[1], key[2])
+            )
+            self._inflight[key] = future
+            future.add_done_callback(lambda _f, _k=key: self._inflight.pop(_k, None))
+        return future
+
+    async def _deliver(self, watch: _Watch, watch_date: str, slots: list, now_str: str) -> bool:
+        """Run one watch's match/auto-book logic against fresh slots.
+
+        Returns True if the slot set for this date changed (or was seen
+        for the first time); the scheduler folds that into the per-watch
+        unchanged_polls counter once per tick.
+        """
+        matched_slot = next(
+            (
+                s for s in slots
+                if _matches_time(s.start, watch.exact_times, watch.time_ranges)
+            ),
+            None,
+        )
+        current = frozenset(s.start for s in slots if s.start)
+        previous = watch.last_available.get(watch_date)
+        watch.last_available[watch_date] = current
+        changed = previous is None or current != previous
+        if not matched_slot:
+            # Only report availability when it changes (and show the diff,
+            # not the full list) — identical "Available: ..." messages every
+            # poll are SMS spam. The first poll just sets the baseline.
+            if previous is not None and current != previous:
+                added = sorted(current - previous)
+                removed = sorted(previous - current)
+                parts = []
+                if added:
+                    parts.append("new: " + ", ".join(added))
+                if removed:
+                    parts.append("gone: " + ", ".join(removed))
+                try:
+                    await watch.notify(
+                        f"[{now_str}] Availability changed for {watch_date} "
+                        f"({'; '.join(parts)}) — no preferred-time match yet."
+                    )
+                except Exception:
+                    self.remove(watch.id)
+            return changed
+
+        match_time = matched_slot.start or "unknown"
+        config_token = matched_slot.token
+
+        if watch.auto_book:
+            # Auto-book immediately
+            success, msg, resy_token, cal_events = await _auto_book(
+                watch.resy, config_token, watch_date, watch.party_size,
+                watch.venue_name, watch.venue_id, match_time, watch.terms,
+            )
+
+            # Build calendar links
+            cal_links = []
+            if watch.base_url:
+                for cal_id, label in cal_events:
+                    cal_links.append({
+                        "url": f"{watch.base_url}/cal/{cal_id}",
+                        "cal_id": cal_id,
+                        "label": label,
+                    })
+
+            if success:
+                self._watches.pop(watch.id, None)
+                await update_entry_async(watch.created_at, {
+                    "status": "booked",
+                    "booked_at": datetime.now().isoformat(),
+                    "booked_time": match_time,
+                    "booked_date": watch_date,
+                })
+                try:
+                    await watch.notify(msg, calendar_links=cal_links)
+                except Exception:
+                    pass
+            else:
+                # Check if it was a booking conflict (412)
+                is_conflict = "conflict" in msg.lower()
+                try:
+                    await watch.notify(
+                        f"[{now_str}] Auto-book failed: {msg}"
+                        + (" Continuing to watch..." if is_conflict else " Retrying next cycle..."),
+                    )
+                except Exception:
+                    self.remove(watch.id)
+        else:
+            # Legacy notify-only mode (shouldn't happen with new flow, but safe fallback)
+            match_info = {
+                "time": match_time,
+                "config_token": config_token,
+                "venue_name": watch.venue_name,
+                "venue_id": watch.venue_id,
+                "date": watch_date,
+                "party_size": watch.party_size,
+            }
+            try:
+                await watch.notify(
+                    f"[{now_str}] Match found: {match_time}!",
+                    match=match_info,
+                )
+            except Exception:
+                self.remove(watch.id)
+        return changed
+
+
+registry = WatchRegistry()
+
+MAX_WATCHES_PER_USER = 10  # per websocket connection / per Twilio number
+
+
+_TYPING_DELAY = 0.25  # seconds before the typing indicator is worth showing
+
+
+async def _receive_json(ws: WebSocket) -> dict:
+    """receive_json on the orjson codec, accepting text or binary frames."""
+    message = await ws.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000))
+    data = message.get("bytes")
+    if data is None:
+        data = message.get("text", "")
+    return orjson.loads(data)
+
+
+@app.websocket("/ws")
+async def websocket_endpoint(ws: WebSocket):
+    await ws.accept()
+
+    async def _send(payload: dict):
+        # Binary frames + orjson: one syscall per turn instead of one per
+        # event, and no stdlib json.dumps on the hot path.
+        await ws.send_bytes(orjson.dumps(payload))
+
+    try:
+        resy = _get_resy()
+    except RuntimeError as e:
+        await _send({"type": "bot_message", "text": f"Error: {e}"})
+        await ws.close()
+        return
+
+    session = ChatSession(resy)
+    watch_ids: list[int] = []
+
+    async def ws_notify(text: str, match=None, calendar_links=None):
+        payload = {"type": "watch_update", "text": text}
+        if match is not None:
+            payload["match"] = match
+        if calendar_links:
+            payload["calendar_links"] = calendar_links
+        await _send(payload)
+
+    async def _typing_later():
+        # Only show the indicator if the turn is actually slow; fast
+        # turns fold straight into the batched reply below.
+        await asyncio.sleep(_TYPING_DELAY)
+        try:
+            await _send({"type": "typing", "text": ""})
+        except Exception:
+            pass
+
+    try:
+        while True:
+            data = await _receive_json(ws)
+
+            if data.get("type") == "message":
+                user_text = data.get("text", "").strip()
+                if not user_text:
+                    continue
+
+                typing_task = asyncio.create_task(_typing_later())
+                try:
+                    events = await session.process_message(user_text)
+                except Exception as e:
+                    log.exception("WebSocket process_message failed, resetting session")
+                    session = ChatSession(resy)
+                    await _send({
+                        "type": "bot_message",
+                        "text": "Sorry, something went wrong. Please try again.",
+                    })
+                    continue
+                finally:
+                    typing_task.cancel()
+
+                # Accumulate the turn's events into one batched frame
+                batch = []
+                for event in events:
+                    if event["type"] == "text":
+                        batch.append({
+                            "type": "bot_message",
+                            "text": event["text"],
+                        })
+                    elif event["type"] == "watch":
+                        # Prune watches that finished (booked/expired) so
+                        # they don't count against the cap
+                        watch_ids = [i for i in watch_ids if registry.active(i)]
+                        if len(watch_ids) >= MAX_WATCHES_PER_USER:
+                            batch.append({
+                                "type": "bot_message",
+                                "text": f"You already have {MAX_WATCHES_PER_USER} active watches — "
+                                        "stop one before arming another.",
+                            })
+                            continue
+                        watch_params = event["params"]
+                        # WebSocket doesn't have a base_url from request,
+                        # so calendar links use relative paths via /cal/{id}
+                        watch_params["base_url"] = ""
+                        try:
+                            watch_ids.append(
+                                await registry.add(resy, watch_params, ws_notify)
+                            )
+                        except WatchLimitError:
+                            batch.append({
+                                "type": "bot_message",
+                                "text": "The server is at watch capacity right now — please try again later.",
+                            })
+                            continue
+                        except ValueError as e:
+                            batch.append({
+                                "type": "bot_message",
+                                "text": f"Couldn't arm that watch: {e}",
+                            })
+                            continue
+                        batch.append({
+                            "type": "bot_message",
+                            "text": "Watch armed with auto-book! I'll book instantly when a match opens up.",
+                        })
+                    elif event["type"] == "calendar":
+                        batch.append({
+                            "type": "calendar_link",
+                            "url": f"/cal/{event['cal_id']}",
+                            "label": event.get("label", "reservation"),
+                        })
+
+                if batch:
+                    await _send({"type": "batch", "events": batch})
+
+    except WebSocketDisconnect:
+        pass
+    finally:
+        for watch_id in watch_ids:
+            registry.remove(watch_id)
+
+
+# ---------------------------------------------------------------------------
+# Twilio webhooks (WhatsApp + SMS)
+# ---------------------------------------------------------------------------
+
+# Sessions are keyed per user ("{channel}:{from_number}") so conversations
+# don't bleed across users or across WhatsApp and SMS. With REDIS_URL set,
+# session state round-trips through Redis (1h expiry) so Twilio can route
+# consecutive messages to different uvicorn workers; otherwise sessions stay
+# in-process.
+_sessions: dict[str, ChatSession] = {}  # in-process fallback store
+_user_watch_ids: dict[str, list[int]] = {}  # user key → active watch ids
+SESSION_TTL = 3600  # seconds
+
+_redis = None
+if os.getenv("REDIS_URL"):
+    try:
+        import redis.asyncio as redis_async
+        _redis = redis_async.from_url(os.getenv("REDIS_URL"))
+    except ImportError:
+        log.warning("REDIS_URL set but redis is not installed; sessions stay in-process")
+
+_WATCH_CANCEL_CHANNEL = "watch:cancel"
+_cancel_listener_task: asyncio.Task | None = None
+
+
+async def _load_session(user_key: str, resy: ResyClient) -> ChatSession:
+    """Fetch the user's ChatSession — from Redis when configured."""
+    if _redis is not None:
+        try:
+            blob = await _redis.get(f"session:{user_key}")
+        except Exception:
+            log.exception("Redis get failed for %s", user_key)
+            blob = None
+        if blob:
+            try:
+                return ChatSession.from_state(resy, json.loads(blob))
+            except Exception:
+                log.exception("Could not restore session for %s, starting fresh", user_key)
+        return ChatSession(resy)
+    session = _sessions.get(user_key)
+    if session is None:
+        session = _sessions[user_key] = ChatSession(resy)
+    return session
+
+
+async def _save_session(user_key: str, session: ChatSession) -> None:
+    """Persist the session after a turn."""
+    if _redis is None:
+        _sessions[user_key] = session
+        return
+    try:
+        await _redis.set(
+            f"session:{user_key}",
+            json.dumps(session.export_state()),
+            ex=SESSION_TTL,
+        )
+    except Exception:
+        log.exception("Could not persist session for %s", user_key)
+
+
+async def _broadcast_watch_cancel(user_key: str) -> None:
+    """Tell other workers to drop this user's watches."""
+    if _redis is not None:
+        try:
+            await _redis.publish(_WATCH_CANCEL_CHANNEL, user_key)
+        except Exception:
+            log.exception("Could not publish watch cancel for %s", user_key)
+
+
+def _ensure_cancel_listener() -> None:
+    global _cancel_listener_task
+    if _redis is None:
+        return
+    if _cancel_listener_task is None or _cancel_listener_task.done():
+        _cancel_listener_task = asyncio.create_task(_watch_cancel_listener())
+
+
+async def _watch_cancel_listener() -> None:
+    """Apply cross-worker watch cancellations published via Redis."""
+    pubsub = _redis.pubsub()
+    await pubsub.subscribe(_WATCH_CANCEL_CHANNEL)
+    async for message in pubsub.listen():
+        if message.get("type") != "message":
+            continue
+        user_key = message["data"]
+        if isinstance(user_key, bytes):
+            user_key = user_key.decode()
+        registry.remove_owner(user_key)
+        _user_watch_ids.pop(user_key, None)
+
+# Per-recipient outbound queues: watch updates arriving within the debounce
+# window are coalesced into a single Twilio send instead of one API round-trip
+# per update.
+_outbound_queues: dict[tuple[str, str], asyncio.Queue] = {}
+_OUTBOUND_DEBOUNCE = 1.5  # seconds
+
+
+def _queue_outbound(channel: str, to: str, text: str) -> None:
+    """Enqueue a message for debounced delivery to a recipient."""
+    key = (channel, to)
+    queue = _outbound_queues.get(key)
+    if queue is None:
+        queue = _outbound_queues[key] = asyncio.Queue()
+        asyncio.create_task(_outbound_worker(channel, to, queue))
+    queue.put_nowait(text)
+
+
+async def _outbound_worker(channel: str, to: str, queue: asyncio.Queue) -> None:
+    """Drain a recipient's queue, joining bursts into one Twilio call.
+
+    The actual send runs in a thread so the Twilio round-trip never blocks
+    the event loop.
+    """
+    while True:
+        parts = [await queue.get()]
+        await asyncio.sleep(_OUTBOUND_DEBOUNCE)
+        while not queue.empty():
+            parts.append(queue.get_nowait())
+        try:
+            await asyncio.to_thread(
+                send_message, "\n\n".join(parts), to=to, channel=channel,
+            )
+        except Exception as e:
+            log.error("Failed to send %s to %s: %s", channel, to, e)
+
+
+async def _handle_twilio_message(request: Request, channel: str):
+    """Shared handler for both WhatsApp and SMS webhooks."""
+    form = await request.form()
+    body = (form.get("Body") or "").strip()
+    from_number = form.get("From", "")
+
+    if not body:
+        return Response(status_code=200)
+
+    async def _reply(text: str):
+        try:
+            await asyncio.to_thread(send_message, text, to=from_number, channel=channel)
+        except Exception as e:
+            log.error("Failed to send %s to %s: %s", channel, from_number, e)
+
+    try:
+        resy_client = _get_resy()
+    except RuntimeError as e:
+        await _reply(str(e))
+        return Response(status_code=200)
+
+    _ensure_cancel_listener()
+    user_key = f"{channel}:{from_number}"
+    session = await _load_session(user_key, resy_client)
+    watch_ids = _user_watch_ids.setdefault(user_key, [])
+
+    # Prune watches that already finished (booked/expired)
+    watch_ids[:] = [i for i in watch_ids if registry.active(i)]
+
+    # Handle special commands
+    lower = body.lower().strip()
+    _is_status_cmd = (
+        lower in ("log", "status", "dashboard", "my watches", "my reservations", "my bookings")
+        or re.search(r"\b(show|view|get|check)\b.+\b(log|status|reservations|watches|bookings|dashboard)\b", lower)
+        or re.search(r"\b(my|the)\s+(log|status|reservations|watches|bookings)\b", lower)
+    )
+    if _is_status_cmd:
+        entries = await _reconcile_log()
+        today_str = date.today().isoformat()
+        watching = [e for e in entries if e and e.get("status") == "watching"
+                    and (e.get("date") or "") >= today_str]
+        watch_booked = [e for e in entries if e and e.get("status") == "booked"
+                        and e.get("auto_book")]
+        booked = [e for e in entries if e and e.get("status") == "booked"]
+        cancelled = [e for e in entries if e and e.get("status") == "cancelled"]
+        upcoming = [e for e in booked if (e.get("date") or "") >= today_str]
+        past = [e for e in booked if (e.get("date") or "") < today_str]
+
+        lines = []
+        if watching:
+            lines.append("Active watches:")
+            for e in watching:
+                times = ", ".join(e.get("preferred_times", []))
+                lines.append(f"- {e.get('venue', '?')} on {e.get('date', '?')} for {e.get('party_size', '?')} ({times})")
+
+        if upcoming:
+            lines.append("\nUpcoming reservations:")
+            for e in upcoming:
+                line = f"- {e.get('venue', '?')} on {e.get('date', '?')} at {e.get('time', '?')} for {e.get('party_size', '?')}"
+                deadline = e.get("cancellation_deadline")
+                if deadline:
+                    line += f"\n  Cancel by: {deadline}"
+                    fee = e.get("cancellation_fee")
+                    if fee:
+                        line += f" (fee: {fee})"
+                lines.append(line)
+
+        if past:
+            lines.append("\nPast reservations:")
+            for e in past:
+                lines.append(f"- {e.get('venue', '?')} on {e.get('date', '?')} at {e.get('time', '?')}")
+
+        if cancelled:
+            lines.append("\nCancelled:")
+            for e in cancelled:
+                source = "via bot" if e.get("source") == "bot" else "on Resy"
+                line = f"- {e.get('venue', '?')} on {e.get('date', '?')}"
+                if e.get("cancelled_at"):
+                    line += f" (cancelled {e['cancelled_at'][:10]}, {source})"
+                else:
+                    line += f" ({source})"
+                lines.append(line)
+
+        if not lines:
+            lines.append("No watches or reservations yet.")
+
+        await _reply("\n".join(lines))
+        return Response(status_code=200)
+
+    if lower in ("stop watching", "cancel watch", "stop watch", "cancel watching"):
+        cancelled_any = bool(watch_ids) or registry.remove_owner(user_key)
+        for watch_id in watch_ids:
+            registry.remove(watch_id)
+        watch_ids.clear()
+        await _broadcast_watch_cancel(user_key)
+        if cancelled_any:
+            await _reply("All watches cancelled.")
+        else:
+            await _reply("No active watches to cancel.")
+        return Response(status_code=200)
+
+    # Process message through ChatSession
+    try:
+        events = await session.process_message(body)
+    except Exception:
+        log.exception("%s process_message failed, resetting session", channel)
+        await _save_session(user_key, ChatSession(resy_client))
+        try:
+            await _reply("Sorry, something went wrong. Please try again.")
+        except Exception:
+            pass
+        return Response(status_code=200)
+
+    base_url = str(request.base_url).rstrip("/")
+
+    # Consolidate all text events into a single message
+    text_parts: list[str] = []
+    for event in events:
+        if event["type"] == "text":
+            text_parts.append(event["text"])
+        elif event["type"] == "watch":
+            _ch = channel
+            _to = from_number
+            _base = base_url
+
+            async def _notify(text: str, match=None, calendar_links=None, _channel=_ch, _dest=_to, _bu=_base):
+                msg = text
+                if match:
+                    msg += (
+                        f"\n\nMatch: {match['venue_name']} on {match['date']}"
+                        f" at {match['time']} for {match['party_size']}."
+                    )
+                if calendar_links:
+                    for cl in calendar_links:
+                        label = cl.get("label", "reservation")
+                        url = cl.get("url", "")
+                        if label == "cancellation":
+                            msg += f"\n\nAdd cancellation deadline reminder to your calendar: {url}"
+                        else:
+                            msg += f"\n\nAdd reservation to your calendar: {url}"
+                _queue_outbound(_channel, _dest, msg)
+
+            # Prune finished watches, then enforce the per-user cap
+            watch_ids[:] = [i for i in watch_ids if registry.active(i)]
+            if len(watch_ids) >= MAX_WATCHES_PER_USER:
+                text_parts.append(
+                    f"You already have {MAX_WATCHES_PER_USER} active watches — "
+                    'send "stop watching" before arming another.'
+                )
+                continue
+            watch_params = event["params"]
+            watch_params["base_url"] = base_url
+            try:
+                watch_ids.append(
+                    await registry.add(resy_client, watch_params, _notify, owner=user_key)
+                )
+            except WatchLimitError:
+                text_parts.append("The server is at watch capacity right now — please try again later.")
+                continue
+            except ValueError as e:
+                text_parts.append(f"Couldn't arm that watch: {e}")
+                continue
+            text_parts.append("Watch armed with auto-book! I'll book instantly when a match opens up.")
+        elif event["type"] == "calendar":
+            cal_url = f"{base_url}/cal/{event['cal_id']}"
+            label = event.get("label", "reservation")
+            if label == "cancellation":
+                text_parts.append(f"Add cancellation deadline reminder to your calendar: {cal_url}")
+            else:
+                text_parts.append(f"Add reservation to your calendar: {cal_url}")
+
+    await _save_session(user_key, session)
+
+    if text_parts:
+        combined = "\n\n".join(text_parts)
+        if channel == "whatsapp":
+            combined = _md_to_whatsapp(combined)
+        await _reply(combined)
+
+    return Response(status_code=200)
+
+
+@app.post("/whatsapp")
+async def whatsapp_webhook(request: Request):
+    return await _handle_twilio_message(request, channel="whatsapp")
+
+
+@app.post("/sms")
+async def sms_webhook(request: Request):
+    return await _handle_twilio_message(request, channel="sms")
+
+
+if __name__ == "__main__":
+    if os.getenv("DEV"):
+        # Dev mode: auto-reload, single worker, default event loop
+        uvicorn.run("app:app", host="0.0.0.0", port=8080, reload=True)
+    else:
+        # uvloop + httptools cut per-request event-loop overhead; workers
+        # scale across cores. Note: sessions and watches live in-process,
+        # so WEB_CONCURRENCY > 1 needs externalized state (e.g. Redis).
+        uvicorn.run(
+            "app:app",
+            host="0.0.0.0",
+            port=8080,
+            loop="uvloop",
+            http="httptools",
+            workers=int(os.getenv("WEB_CONCURRENCY", "1")),
+            reload=False,
+        )
@@ -1,702 +1,840 @@
-"""Gemini integration for the reservation chat bot."""
-
-import json
-import logging
-import os
-from datetime import date, datetime
-
-from google import genai
-from google.genai import types
-from resy_api import ResyClient, ResyBookingConflict
-from log_utils import load_log, save_log, log_entry
-from calendar_utils import create_cancellation_reminder, create_reservation_event
-
-log = logging.getLogger(__name__)
-
-SYSTEM_PROMPT = """You are a friendly restaurant reservation assistant powered by Resy.
-Keep your tone warm and conversational — like a helpful friend, not a formal concierge.
-
-FORMATTING: Use plain text only. No markdown, no asterisks, no bold formatting.
-Use dashes (- item) for lists.
-
-HOW TO HELP:
-1. Search for the restaurant first. Show the user what you found and ask which one they want.
-2. Once they pick a restaurant, find available slots. Show the times and ask which one works.
-   If their preferred time isn't available, offer to watch for cancellations.
-3. When they pick a time, call prepare_booking. This gives you cancellation policy, fees, and
-   deadlines. Share ALL of these with the user and ask if they want to go ahead.
-4. Only call confirm_booking after they say yes.
-
-CANCELLING:
-When the user wants to cancel, call list_reservations to show their upcoming reservations.
-Ask which one they want to cancel. Once they pick one, confirm they're sure, then call
-cancel_reservation with the resy_token.
-
-WATCHING FOR CANCELLATIONS / SNIPING:
-CRITICAL RULE: Before calling prepare_watch, you MUST check the find_slots results to see if
-any available times already fall within the user's requested window. For example, if slots include
-8:00 PM and the user asks to "watch for anything between 7 and 9 PM", do NOT set up a watch.
-Instead say something like "Actually, 8:00 PM is available right now! Want me to book that?"
-Only use prepare_watch when NO available slots match the user's preferred times or range.
-
-When the user wants to watch for a time slot to open up, or "snipe" when tables are released:
-1. First call find_slots (if not already done) to set up venue context.
-2. Call prepare_watch with a time — this fetches cancellation terms for the venue.
-   Present ALL terms (policy, fees, deadline) to the user and explain that once armed,
-   the bot will auto-book instantly when a match is found.
-3. Only call confirm_watch after the user agrees to the terms.
-   - preferred_times: list of "HH:MM" or "HH:MM-HH:MM" range strings.
-     Examples: ["19:00"], ["19:00-21:30"], ["18:00", "19:00", "20:00"]
-     Use ranges when the user says "anything between 7 and 9:30 PM" → ["19:00-21:30"]
-   - snipe_at: optional ISO datetime for when tables are released (e.g. "2026-03-16T09:00:00").
-     Ask the user what time the restaurant releases tables, then build this datetime.
-     The bot will sleep until 30s before this time, then poll aggressively every 2 seconds.
-   - dates: optional list of "YYYY-MM-DD" strings for multi-date watching.
-     Defaults to the single date from venue context. Use when user wants to check multiple dates.
-
-IMPORTANT:
-- Pass the EXACT time string from find_slots to prepare_booking.
-- If a tool returns an error, share the error with the user.
-- Never make up times, prices, or policies.
-- Default to party of 2 if not specified.
-
-AFTER BOOKING:
-When confirm_booking succeeds, two calendar invites are automatically created:
-one for the reservation itself and one for the cancellation deadline reminder.
-Let the user know they'll get links to add them to their calendar.
-
-Today is {today}."""
-
-TOOLS = [
-    types.Tool(function_declarations=[
-        types.FunctionDeclaration(
-            name="search_restaurant",
-            description="Search for restaurants on Resy by name.",
-            parameters=types.Schema(
-                type="OBJECT",
-                properties={
-                    "query": types.Schema(type="STRING", description="Restaurant name"),
-                },
-                required=["query"],
-            ),
-        ),
-        types.FunctionDeclaration(
-            name="find_slots",
-            description="Find available time slots for a restaurant on a date. Stores the venue context for subsequent booking calls.",
-            parameters=types.Schema(
-                type="OBJECT",
-                properties={
-                    "venue_id": types.Schema(type="INTEGER", description="Resy venue ID from search results"),
-                    "venue_name": types.Schema(type="STRING", description="Restaurant name"),
-                    "party_size": types.Schema(type="INTEGER", description="Number of guests (default 2)"),
-                    "date": types.Schema(type="STRING", description="Date in YYYY-MM-DD format"),
-                },
-                required=["venue_id", "venue_name", "party_size", "date"],
-            ),
-        ),
-        types.FunctionDeclaration(
-            name="prepare_booking",
-            description="Prepare a reservation for a specific time. Returns cancellation policy and fees. Present these terms to the user and wait for confirmation before calling confirm_booking. Pass the EXACT time string from find_slots.",
-            parameters=types.Schema(
-                type="OBJECT",
-                properties={
-                    "time": types.Schema(type="STRING", description="Time from find_slots results, e.g. '2026-03-09 21:15:00'"),
-                },
-                required=["time"],
-            ),
-        ),
-        types.FunctionDeclaration(
-            name="confirm_booking",
-            description="Finalize the reservation after the user has accepted the cancellation terms.",
-            parameters=types.Schema(
-                type="OBJECT",
-                properties={},
-            ),
-        ),
-        types.FunctionDeclaration(
-            name="prepare_watch",
-            description="Prepare a watch for a time slot to open up. Fetches cancellation terms for the venue. Present these terms to the user and explain that once armed, the bot will auto-book instantly when a match is found. Wait for confirmation before calling confirm_watch.",
-            parameters=types.Schema(
-                type="OBJECT",
-                properties={
-                    "time": types.Schema(type="STRING", description="Any available time from find_slots to look up terms, e.g. '2026-03-09 21:15:00'. If no slots exist, omit and the system will fetch terms using any available slot."),
-                },
-            ),
-        ),
-        types.FunctionDeclaration(
-            name="confirm_watch",
-            description="Arm the watch after user has accepted the cancellation terms from prepare_watch. The bot will auto-book instantly when a matching slot opens.",
-            parameters=types.Schema(
-                type="OBJECT",
-                properties={
-                    "preferred_times": types.Schema(
-                        type="ARRAY",
-                        items=types.Schema(type="STRING"),
-                        description="Preferred times as HH:MM or HH:MM-HH:MM ranges, e.g. ['19:00'] or ['19:00-21:30']",
-                    ),
-                    "snipe_at": types.Schema(type="STRING", description="Optional ISO datetime when tables are released, e.g. '2026-03-16T09:00:00'. Bot sleeps until 30s before, then polls every 2 seconds."),
-                    "dates": types.Schema(
-                        type="ARRAY",
-                        items=types.Schema(type="STRING"),
-                        description="Optional list of YYYY-MM-DD dates to watch. Defaults to the single date from venue context.",
-                    ),
-                },
-                required=["preferred_times"],
-            ),
-        ),
-        types.FunctionDeclaration(
-            name="create_calendar_reminder",
-            description="Create a calendar reminder (.ics file) for the cancellation deadline of the most recent booking. Use when the user asks for a calendar reminder.",
-            parameters=types.Schema(type="OBJECT", properties={}),
-        ),
-        types.FunctionDeclaration(
-            name="get_log",
-            description="Retrieve the reservation log showing bookings and active watches.",
-            parameters=types.Schema(type="OBJECT", properties={}),
-        ),
-        types.FunctionDeclaration(
-            name="list_reservations",
-            description="List the user's upcoming Resy reservations. Use when they ask about their reservations or want to cancel one.",
-            parameters=types.Schema(type="OBJECT", properties={}),
-        ),
-        types.FunctionDeclaration(
-            name="cancel_reservation",
-            description="Cancel a reservation. Must call list_reservations first to get the resy_token. Always confirm with the user before cancelling.",
-            parameters=types.Schema(
-                type="OBJECT",
-                properties={
-                    "resy_token": types.Schema(type="STRING", description="The resy_token from list_reservations"),
-                },
-                required=["resy_token"],
-            ),
-        ),
-    ])
-]
-
-
-# ---------------------------------------------------------------------------
-# Time parsing helper
-# ---------------------------------------------------------------------------
-
-def _parse_hhmm(time_str: str) -> str | None:
-    """Extract HH:MM (24h) from various time formats."""
-    s = time_str.strip()
-    # "2026-03-09 22:00:00" → take time part
-    if " " in s:
-        _, time_part = s.rsplit(" ", 1)
-        if ":" in time_part:
-            parts = time_part.split(":")
-            return f"{parts[0]}:{parts[1]}"
-    # "22:00:00" or "22:00" (no AM/PM)
-    upper = s.upper()
-    if ":" in s and "AM" not in upper and "PM" not in upper:
-        parts = s.split(":")
-        return f"{parts[0]}:{parts[1]}"
-    # "10:00 PM", "9.45pm", "5pm", "9:15 AM", etc.
-    for suffix in ("PM", "AM"):
-        if suffix in upper:
-            raw = upper.replace(suffix, "").strip().rstrip(".")
-            raw = raw.replace(".", ":")  # "9.45" → "9:45"
-            parts = raw.split(":")
-            try:
-                hour = int(parts[0])
-                minute = int(parts[1]) if len(parts) > 1 else 0
-            except ValueError:
-                return None
-            if suffix == "PM" and hour != 12:
-                hour += 12
-            elif suffix == "AM" and hour == 12:
-                hour = 0
-            return f"{hour:02d}:{minute:02d}"
-    return None
-
-
-class ChatSession:
-    def __init__(self, resy_client: ResyClient):
-        self.resy = resy_client
-
-        # Server-side state — Gemini never sees config tokens or book tokens
-        self._slot_cache: dict[str, dict] = {}   # start_time → raw slot dict
-        self._venue_context: dict | None = None   # venue_id, venue_name, party_size, date
-        self._pending_booking: dict | None = None # config_token, time, details (terms only)
-        self._pending_watch: dict | None = None   # terms + venue_context for confirm_watch
-        self._last_booking: dict | None = None    # saved after confirm for calendar on demand
-        self._pending_calendars: list[tuple[str, str]] = []  # (cal_id, label) to send
-        self._reservation_tokens: dict[str, dict] = {}  # resy_token → reservation info
-
-        self.client = genai.Client(
-            vertexai=True,
-            project=os.getenv("GOOGLE_VERTEX_PROJECT_ID", "agentic-ai-for-analytics"),
-            location=os.getenv("GOOGLE_VERTEX_REGION", "us-central1"),
-        )
-        self.chat = self.client.chats.create(
-            model="gemini-2.0-flash",
-            config=types.GenerateContentConfig(
-                system_instruction=SYSTEM_PROMPT.format(today=date.today().isoformat()),
-                tools=TOOLS,
-            ),
-        )
-
-    # ------------------------------------------------------------------
-    # Slot lookup
-    # ------------------------------------------------------------------
-
-    def _resolve_slot(self, requested_time: str) -> dict | None:
-        """Find a cached slot matching the requested time (any format)."""
-        # Exact match first
-        if requested_time in self._slot_cache:
-            return self._slot_cache[requested_time]
-        # Fuzzy match by HH:MM
-        req_hhmm = _parse_hhmm(requested_time)
-        if req_hhmm:
-            for cached_time, cached_slot in self._slot_cache.items():
-                if _parse_hhmm(cached_time) == req_hhmm:
-                    return cached_slot
-        return None
-
-    # ------------------------------------------------------------------
-    # Tool execution
-    # ------------------------------------------------------------------
-
-    def _execute_tool(self, tool_name: str, tool_input: dict) -> dict:
-        try:
-            if tool_name == "search_restaurant":
-                venues = self.resy.search_venues(tool_input["query"])
-                if not venues:
-                    return {"error": "No restaurants found matching that search."}
-                return {"venues": venues}
-
-            elif tool_name == "find_slots":
-                venue_id = int(tool_input["venue_id"])
-                party_size = int(tool_input.get("party_size", 2))
-                day = tool_input["date"]
-                venue_name = tool_input.get("venue_name", "Unknown")
-
-                self._venue_context = {
-                    "venue_id": venue_id,
-                    "venue_name": venue_name,
-                    "party_size": party_size,
-                    "date": day,
-                }
-
-                slots = self.resy.find_slots(venue_id, party_size, day)
-                if not slots:
-                    return {"error": "No available time slots found for that date."}
-
-                self._slot_cache = {}
-                simplified = []
-                for s in slots:
-                    start = s.get("date", {}).get("start", "unknown")
-                    self._slot_cache[start] = s
-                    simplified.append({
-                        "time": start,
-                        "type": s.get("config", {}).get("type", ""),
-                    })
-                return {"slots": simplified}
-
-            elif tool_name == "prepare_booking":
-                if not self._venue_context:
-                    return {"error": "No venue context. Call find_slots first."}
-
-                requested_time = tool_input.get("time", "")
-                slot = self._resolve_slot(requested_time)
-                if not slot:
-                    available = list(self._slot_cache.keys())
-                    return {
-                        "error": f"Time '{requested_time}' not found in available slots. "
-                        f"Available: {available}"
-                    }
-
-                ctx = self._venue_context
-                config_token = slot["config"]["token"]
-                details = self.resy.get_details(
-                    config_token, ctx["date"], ctx["party_size"],
-                )
-
-                if not details["book_token"]:
-                    return {"error": "Could not get a booking token. The slot may no longer be available."}
-
-                # Store config_token (not book_token) so confirm_booking can
-                # re-fetch a fresh book_token right before booking.
-                # This avoids the 412 PRECONDITION FAILED error caused by
-                # expired book_tokens.
-                self._pending_booking = {
-                    "config_token": config_token,
-                    "time": requested_time,
-                    "terms": {
-                        "cancellation_policy": details.get("cancellation_policy"),
-                        "cancellation_fee": details.get("cancellation_fee"),
-                        "cancellation_deadline": details.get("cancellation_deadline"),
-                        "payment_type": details.get("payment_type"),
-                        "payment_total": details.get("payment_total"),
-                    },
-                }
-
-                return {
-                    "status": "ready",
-                    "message": "Present these terms to the user. Do NOT call confirm_booking until they agree.",
-                    "cancellation_policy": details.get("cancellation_policy"),
-                    "cancellation_fee": details.get("cancellation_fee"),
-                    "cancellation_deadline": details.get("cancellation_deadline"),
-                    "payment_type": details.get("payment_type"),
-                    "payment_total": details.get("payment_total"),
-                }
-
-            elif tool_name == "confirm_booking":
-                if not self._pending_booking:
-                    return {"error": "No pending booking. Call prepare_booking first."}
-                if not self._venue_context:
-                    return {"error": "No venue context. Start over with find_slots."}
-
-                pending = self._pending_booking
-                ctx = self._venue_context
-
-                # Re-fetch a fresh book_token right before booking.
-                # Book tokens expire quickly, so we can't reuse the one
-                # from prepare_booking — that causes 412 errors.
-                try:
-                    fresh_details = self.resy.get_details(
-                        pending["config_token"], ctx["date"], ctx["party_size"],
-                    )
-                except Exception as e:
-                    log.exception("Failed to refresh booking details")
-                    return {"error": f"Could not refresh booking details: {e}"}
-
-                book_token = fresh_details.get("book_token")
-                payment_method_id = fresh_details.get("payment_method_id")
-
-                if not book_token:
-                    return {"error": "The slot is no longer available. Try picking another time."}
-
-                try:
-                    result = self.resy.book(book_token, payment_method_id)
-                except ResyBookingConflict as e:
-                    log.warning("Booking conflict: %s", e)
-                    return {"error": str(e)}
-                except Exception as e:
-                    log.exception("Booking failed")
-                    return {"error": f"Booking failed: {e}"}
-
-                resy_token = result.get("resy_token", "N/A")
-
-                log_entry({
-                    "status": "booked",
-                    "source": "bot",
-                    "venue": ctx["venue_name"],
-                    "venue_id": ctx["venue_id"],
-                    "date": ctx["date"],
-                    "time": pending["time"],
-                    "party_size": ctx["party_size"],
-                    "confirmation_token": resy_token,
-                    "cancellation_policy": pending["terms"].get("cancellation_policy"),
-                    "cancellation_deadline": pending["terms"].get("cancellation_deadline"),
-                    "cancellation_fee": pending["terms"].get("cancellation_fee"),
-                    "booked_at": datetime.now().isoformat(),
-                    "created_at": datetime.now().isoformat(),
-                })
-
-                result_for_gemini = {"result": "Reservation confirmed!"}
-
-                # Create calendar event for the reservation itself
-                try:
-                    res_cal_id = create_reservation_event(
-                        venue_name=ctx["venue_name"],
-                        reservation_date=ctx["date"],
-                        reservation_time=pending["time"],
-                        party_size=ctx["party_size"],
-                    )
-                    self._pending_calendars.append((res_cal_id, "reservation"))
-                    result_for_gemini["reservation_calendar_created"] = True
-                except Exception:
-                    log.exception("Failed to create reservation calendar event")
-
-                # Create calendar reminder for cancellation deadline
-                deadline = pending["terms"].get("cancellation_deadline")
-                if deadline:
-                    try:
-                        cancel_cal_id = create_cancellation_reminder(
-                            venue_name=ctx["venue_name"],
-                            deadline_utc=deadline,
-                            reservation_date=ctx["date"],
-                            reservation_time=pending["time"],
-                            party_size=ctx["party_size"],
-                        )
-                        self._pending_calendars.append((cancel_cal_id, "cancellation"))
-                        result_for_gemini["cancellation_reminder_created"] = True
-                    except Exception:
-                        log.exception("Failed to create cancellation reminder")
-
-                # Save for on-demand calendar creation
-                self._last_booking = {
-                    "venue_name": ctx["venue_name"],
-                    "date": ctx["date"],
-                    "time": pending["time"],
-                    "party_size": ctx["party_size"],
-                    "cancellation_deadline": deadline,
-                }
-                self._pending_booking = None
-                return result_for_gemini
-
-            elif tool_name == "create_calendar_reminder":
-                if not self._last_booking:
-                    return {"error": "No recent booking found. Book a reservation first."}
-                deadline = self._last_booking.get("cancellation_deadline")
-                if not deadline:
-                    return {"error": "This booking has no cancellation deadline."}
-                booking = self._last_booking
-                cal_id = create_cancellation_reminder(
-                    venue_name=booking["venue_name"],
-                    deadline_utc=deadline,
-                    reservation_date=booking["date"],
-                    reservation_time=booking["time"],
-                    party_size=booking["party_size"],
-                )
-                self._pending_calendars.append((cal_id, "cancellation"))
-                return {"result": "Calendar reminder created. A download link will be sent to you."}
-
-            elif tool_name == "prepare_watch":
-                if not self._venue_context:
-                    return {"error": "No venue context. Call find_slots first."}
-
-                ctx = self._venue_context
-                requested_time = tool_input.get("time", "")
-
-                # Find a config_token to fetch terms — use requested time or any cached slot
-                slot = None
-                if requested_time:
-                    slot = self._resolve_slot(requested_time)
-                if not slot and self._slot_cache:
-                    slot = next(iter(self._slot_cache.values()))
-
-                if not slot:
-                    # No cached slots — fetch fresh ones just for terms lookup
-                    try:
-                        fresh_slots = self.resy.find_slots(
-                            ctx["venue_id"], ctx["party_size"], ctx["date"],
-                        )
-                    except Exception as e:
-                        return {"error": f"Could not fetch slots for terms lookup: {e}"}
-                    if not fresh_slots:
-                        return {
-                            "error": "No slots available at all for this venue/date. "
-                            "Cannot look up cancellation terms.",
-                        }
-                    slot = fresh_slots[0]
-
-                config_token = slot.get("config", {}).get("token", "")
-                try:
-                    details = self.resy.get_details(
-                        config_token, ctx["date"], ctx["party_size"],
-                    )
-                except Exception as e:
-                    return {"error": f"Could not fetch cancellation terms: {e}"}
-
-                terms = {
-                    "cancellation_policy": details.get("cancellation_policy"),
-                    "cancellation_fee": details.get("cancellation_fee"),
-                    "cancellation_deadline": details.get("cancellation_deadline"),
-                    "payment_type": details.get("payment_type"),
-                    "payment_total": details.get("payment_total"),
-                }
-
-                self._pending_watch = {
-                    "terms": terms,
-                    "venue_context": dict(ctx),
-                }
-
-                return {
-                    "status": "ready",
-                    "message": (
-                        "Present these terms to the user. Explain that once the watch "
-                        "is armed, the bot will auto-book instantly when a match is "
-                        "found. Wait for confirmation before calling confirm_watch."
-                    ),
-                    "cancellation_policy": terms["cancellation_policy"],
-                    "cancellation_fee": terms["cancellation_fee"],
-                    "cancellation_deadline": terms["cancellation_deadline"],
-                    "payment_type": terms["payment_type"],
-                    "payment_total": terms["payment_total"],
-                }
-
-            elif tool_name == "confirm_watch":
-                if not self._pending_watch:
-                    return {"error": "No pending watch. Call prepare_watch first."}
-
-                pw = self._pending_watch
-                ctx = pw["venue_context"]
-                terms = pw["terms"]
-                preferred_times = list(tool_input.get("preferred_times", []))
-                snipe_at = tool_input.get("snipe_at")
-                dates = list(tool_input.get("dates", [])) or [ctx["date"]]
-
-                self._pending_watch = None
-
-                params = {
-                    "venue_id": ctx["venue_id"],
-                    "venue_name": ctx["venue_name"],
-                    "party_size": ctx["party_size"],
-                    "date": ctx["date"],
-                    "dates": dates,
-                    "preferred_times": preferred_times,
-                    "auto_book": True,
-                    "terms": terms,
-                }
-                if snipe_at:
-                    params["snipe_at"] = snipe_at
-
-                return {"__watch__": True, "params": params}
-
-            elif tool_name == "get_log":
-                entries = load_log()
-                if not entries:
-                    return {"result": "No reservation log entries yet."}
-                return {"entries": entries}
-
-            elif tool_name == "list_reservations":
-                reservations = self.resy.list_reservations()
-                if not reservations:
-                    return {"result": "You don't have any reservations."}
-                # Only show upcoming ones (today or later)
-                today = date.today().isoformat()
-                upcoming = [r for r in reservations if (r.get("day") or "") >= today]
-                if not upcoming:
-                    return {"result": "You don't have any upcoming reservations."}
-                # Store tokens for cancel lookups
-                self._reservation_tokens = {
-                    r["resy_token"]: r for r in upcoming
-                }
-                # Return simplified info to Gemini (no tokens exposed)
-                simplified = []
-                for r in upcoming:
-                    simplified.append({
-                        "venue_name": r["venue_name"],
-                        "day": r["day"],
-                        "time_slot": r["time_slot"],
-                        "num_seats": r["num_seats"],
-                        "cancel_allowed": r["cancel_allowed"],
-                        "cancellation_policy": r["cancellation_policy"],
-                        "resy_token": r["resy_token"],
-                    })
-                return {"reservations": simplified}
-
-            elif tool_name == "cancel_reservation":
-                resy_token = tool_input.get("resy_token", "")
-                if not resy_token:
-                    return {"error": "Missing resy_token. Call list_reservations first."}
-                try:
-                    result = self.resy.cancel(resy_token)
-                except Exception as e:
-                    log.exception("Cancel failed")
-                    return {"error": f"Cancellation failed: {e}"}
-
-                # Track cancellation in log
-                entries = load_log()
-                matched = False
-                for entry in entries:
-                    if (entry and entry.get("status") == "booked"
-                            and entry.get("confirmation_token") == resy_token):
-                        entry["status"] = "cancelled"
-                        entry["source"] = "bot"
-                        entry["cancelled_at"] = datetime.now().isoformat()
-                        matched = True
-                        break
-                if not matched:
-                    # Fallback: append a new cancelled entry
-                    venue_info = (self._reservation_tokens or {}).get(resy_token, {})
-                    entries.append({
-                        "status": "cancelled",
-                        "source": "bot",
-                        "venue": venue_info.get("venue_name", "Unknown"),
-                        "date": venue_info.get("day", ""),
-                        "time": venue_info.get("time_slot", ""),
-                        "party_size": venue_info.get("num_seats", ""),
-                        "cancelled_at": datetime.now().isoformat(),
-                        "created_at": datetime.now().isoformat(),
-                    })
-                save_log(entries)
-
-                return {"result": "Reservation cancelled successfully."}
-
-            else:
-                return {"error": f"Unknown tool: {tool_name}"}
-
-        except Exception as e:
-            log.exception("Tool %s failed", tool_name)
-            return {"error": str(e)}
-
-    # ------------------------------------------------------------------
-    # Message processing
-    # ------------------------------------------------------------------
-
-    def _extract_parts(self, response) -> tuple[list, list[str]]:
-        """Safely extract function calls and text from a Gemini response."""
-        function_calls = []
-        texts = []
-        try:
-            candidates = response.candidates or []
-            if not candidates:
-                return [], []
-            parts = candidates[0].content.parts or []
-            for part in parts:
-                if part.function_call:
-                    function_calls.append(part.function_call)
-                elif part.text:
-                    texts.append(part.text)
-        except (AttributeError, IndexError) as e:
-            log.warning("Could not parse Gemini response: %s", e)
-        return function_calls, texts
-
-    async def process_message(self, user_text: str) -> list[dict]:
-        """Process a user message. Returns list of event dicts:
-          {"type": "text", "text": "..."}
-          {"type": "watch", "params": {...}}
-          {"type": "calendar", "cal_id": "..."}
-        """
-        events: list[dict] = []
-        self._pending_calendars = []
-
-        response = self.chat.send_message(user_text)
-
-        max_rounds = 10  # safety limit
-        for _ in range(max_rounds):
-            function_calls, texts = self._extract_parts(response)
-            for t in texts:
-                events.append({"type": "text", "text": t})
-
-            if not function_calls:
-                break
-
-            function_responses = []
-            for fc in function_calls:
-                log.info("Gemini called %s(%s)", fc.name, dict(fc.args))
-                result = self._execute_tool(fc.name, dict(fc.args))
-
-                if isinstance(result, dict) and result.get("__watch__"):
-                    params = result["params"]
-                    events.append({"type": "watch", "params": params})
-                    dates_str = ", ".join(params.get("dates", [params["date"]]))
-                    times_str = ", ".join(params["preferred_times"])
-                    snipe_note = ""
-                    if params.get("snipe_at"):
-                        snipe_note = f" Snipe mode active — will poll aggressively starting at {params['snipe_at']}."
-                    result = {
-                        "result": f"Watch armed with auto-book! Watching for "
-                        f"{times_str} at {params['venue_name']} on {dates_str}."
-                        f"{snipe_note} I'll book instantly when a match opens up."
-                    }
-
-                function_responses.append(
-                    types.Part.from_function_response(name=fc.name, response=result)
-                )
-
-            try:
-                response = self.chat.send_message(function_responses)
-            except Exception:
-                log.exception("Gemini send_message failed after tool execution")
-                events.append({"type": "text", "text": "Sorry, I had trouble processing that. Please try again."})
-                break
-
-        for cal_id, label in self._pending_calendars:
-            events.append({"type": "calendar", "cal_id": cal_id, "label": label})
-
-        return events
+"""Gemini integration for the reservation chat bot."""
+
+import asyncio
+import functools
+import json
+import logging
+import os
+import time
+from datetime import date, datetime
+
+from google import genai
+from google.genai import types
+from resy_api import ResyClient, ResyBookingConflict, Slot, slot_from_raw
+from log_utils import load_log_async, log_entry_async, update_entry_async
+from calendar_utils import create_cancellation_reminder, create_reservation_event
+
+log = logging.getLogger(__name__)
+
+SYSTEM_PROMPT = """You are a friendly restaurant reservation assistant powered by Resy.
+Keep your tone warm and conversational — like a helpful friend, not a formal concierge.
+
+FORMATTING: Use plain text only. No markdown, no asterisks, no bold formatting.
+Use dashes (- item) for lists.
+
+HOW TO HELP:
+1. Search for the restaurant first. Show the user what you found and ask which one they want.
+2. Once they pick a restaurant, find available slots. Show the times and ask which one works.
+   If their preferred time isn't available, offer to watch for cancellations.
+3. When they pick a time, call prepare_booking. This gives you cancellation policy, fees, and
+   deadlines. Share ALL of these with the user and ask if they want to go ahead.
+4. Only call confirm_booking after they say yes.
+
+CANCELLING:
+When the user wants to cancel, call list_reservations to show their upcoming reservations.
+Ask which one they want to cancel. Once they pick one, confirm they're sure, then call
+cancel_reservation with the resy_token.
+
+WATCHING FOR CANCELLATIONS / SNIPING:
+CRITICAL RULE: Before calling prepare_watch, you MUST check the find_slots results to see if
+any available times already fall within the user's requested window. For example, if slots include
+8:00 PM and the user asks to "watch for anything between 7 and 9 PM", do NOT set up a watch.
+Instead say something like "Actually, 8:00 PM is available right now! Want me to book that?"
+Only use prepare_watch when NO available slots match the user's preferred times or range.
+
+When the user wants to watch for a time slot to open up, or "snipe" when tables are released:
+1. First call find_slots (if not already done) to set up venue context.
+2. Call prepare_watch with a time — this fetches cancellation terms for the venue.
+   Present ALL terms (policy, fees, deadline) to the user and explain that once armed,
+   the bot will auto-book instantly when a match is found.
+3. Only call confirm_watch after the user agrees to the terms.
+   - preferred_times: list of "HH:MM" or "HH:MM-HH:MM" range strings.
+     Examples: ["19:00"], ["19:00-21:30"], ["18:00", "19:00", "20:00"]
+     Use ranges when the user says "anything between 7 and 9:30 PM" → ["19:00-21:30"]
+   - snipe_at: optional ISO datetime for when tables are released (e.g. "2026-03-16T09:00:00").
+     Ask the user what time the restaurant releases tables, then build this datetime.
+     The bot will sleep until 30s before this time, then poll aggressively every 2 seconds.
+   - dates: optional list of "YYYY-MM-DD" strings for multi-date watching.
+     Defaults to the single date from venue context. Use when user wants to check multiple dates.
+
+IMPORTANT:
+- Pass the EXACT time string from find_slots to prepare_booking.
+- If a tool returns an error, share the error with the user.
+- Never make up times, prices, or policies.
+- Default to party of 2 if not specified.
+
+AFTER BOOKING:
+When confirm_booking succeeds, two calendar invites are automatically created:
+one for the reservation itself and one for the cancellation deadline reminder.
+Let the user know they'll get links to add them to their calendar.
+
+Today is {today}."""
+
+TOOLS = [
+    types.Tool(function_declarations=[
+        types.FunctionDeclaration(
+            name="search_restaurant",
+            description="Search for restaurants on Resy by name.",
+            parameters=types.Schema(
+                type="OBJECT",
+                properties={
+                    "query": types.Schema(type="STRING", description="Restaurant name"),
+                },
+                required=["query"],
+            ),
+        ),
+        types.FunctionDeclaration(
+            name="find_slots",
+            description="Find available time slots for a restaurant on a date. Stores the venue context for subsequent booking calls.",
+            parameters=types.Schema(
+                type="OBJECT",
+                properties={
+                    "venue_id": types.Schema(type="INTEGER", description="Resy venue ID from search results"),
+                    "venue_name": types.Schema(type="STRING", description="Restaurant name"),
+                    "party_size": types.Schema(type="INTEGER", description="Number of guests (default 2)"),
+                    "date": types.Schema(type="STRING", description="Date in YYYY-MM-DD format"),
+                },
+                required=["venue_id", "venue_name", "party_size", "date"],
+            ),
+        ),
+        types.FunctionDeclaration(
+            name="prepare_booking",
+            description="Prepare a reservation for a specific time. Returns cancellation policy and fees. Present these terms to the user and wait for confirmation before calling confirm_booking. Pass the EXACT time string from find_slots.",
+            parameters=types.Schema(
+                type="OBJECT",
+                properties={
+                    "time": types.Schema(type="STRING", description="Time from find_slots results, e.g. '2026-03-09 21:15:00'"),
+                },
+                required=["time"],
+            ),
+        ),
+        types.FunctionDeclaration(
+            name="confirm_booking",
+            description="Finalize the reservation after the user has accepted the cancellation terms.",
+            parameters=types.Schema(
+                type="OBJECT",
+                properties={},
+            ),
+        ),
+        types.FunctionDeclaration(
+            name="prepare_watch",
+            description="Prepare a watch for a time slot to open up. Fetches cancellation terms for the venue. Present these terms to the user and explain that once armed, the bot will auto-book instantly when a match is found. Wait for confirmation before calling confirm_watch.",
+            parameters=types.Schema(
+                type="OBJECT",
+                properties={
+                    "time": types.Schema(type="STRING", description="Any available time from find_slots to look up terms, e.g. '2026-03-09 21:15:00'. If no slots exist, omit and the system will fetch terms using any available slot."),
+                },
+            ),
+        ),
+        types.FunctionDeclaration(
+            name="confirm_watch",
+            description="Arm the watch after user has accepted the cancellation terms from prepare_watch. The bot will auto-book instantly when a matching slot opens.",
+            parameters=types.Schema(
+                type="OBJECT",
+                properties={
+                    "preferred_times": types.Schema(
+                        type="ARRAY",
+                        items=types.Schema(type="STRING"),
+                        description="Preferred times as HH:MM or HH:MM-HH:MM ranges, e.g. ['19:00'] or ['19:00-21:30']",
+                    ),
+                    "snipe_at": types.Schema(type="STRING", description="Optional ISO datetime when tables are released, e.g. '2026-03-16T09:00:00'. Bot sleeps until 30s before, then polls every 2 seconds."),
+                    "dates": types.Schema(
+                        type="ARRAY",
+                        items=types.Schema(type="STRING"),
+                        description="Optional list of YYYY-MM-DD dates to watch. Defaults to the single date from venue context.",
+                    ),
+                },
+                required=["preferred_times"],
+            ),
+        ),
+        types.FunctionDeclaration(
+            name="create_calendar_reminder",
+            description="Create a calendar reminder (.ics file) for the cancellation deadline of the most recent booking. Use when the user asks for a calendar reminder.",
+            parameters=types.Schema(type="OBJECT", properties={}),
+        ),
+        types.FunctionDeclaration(
+            name="get_log",
+            description="Retrieve the reservation log showing bookings and active watches.",
+            parameters=types.Schema(type="OBJECT", properties={}),
+        ),
+        types.FunctionDeclaration(
+            name="list_reservations",
+            description="List the user's upcoming Resy reservations. Use when they ask about their reservations or want to cancel one.",
+            parameters=types.Schema(type="OBJECT", properties={}),
+        ),
+        types.FunctionDeclaration(
+            name="cancel_reservation",
+            description="Cancel a reservation. Must call list_reservations first to get the resy_token. Always confirm with the user before cancelling.",
+            parameters=types.Schema(
+                type="OBJECT",
+                properties={
+                    "resy_token": types.Schema(type="STRING", description="The resy_token from list_reservations"),
+                },
+                required=["resy_token"],
+            ),
+        ),
+    ])
+]
+
+
+# ---------------------------------------------------------------------------
+# Shared Gemini client/config
+# ---------------------------------------------------------------------------
+
+_genai_client: genai.Client | None = None
+
+
+def _get_genai_client() -> genai.Client:
+    """Module-level Vertex client, shared across sessions.
+
+    The client is thread-safe; constructing one per session repeats the
+    auth/metadata lookups that dominate connection-setup latency.
+    """
+    global _genai_client
+    if _genai_client is None:
+        _genai_client = genai.Client(
+            vertexai=True,
+            project=os.getenv("GOOGLE_VERTEX_PROJECT_ID", "agentic-ai-for-analytics"),
+            location=os.getenv("GOOGLE_VERTEX_REGION", "us-central1"),
+        )
+    return _genai_client
+
+
+@functools.lru_cache(maxsize=2)
+def _config_for(today_iso: str) -> types.GenerateContentConfig:
+    """Generation config — identical for every session on a given day."""
+    return types.GenerateContentConfig(
+        system_instruction=SYSTEM_PROMPT.format(today=today_iso),
+        tools=TOOLS,
+    )
+
+
+# ---------------------------------------------------------------------------
+# Short-TTL Resy response caches
+# ---------------------------------------------------------------------------
+
+# Venue search results are effectively static within a session ("noma" vs
+# "Noma" retries, and the same few restaurants dominate across sessions);
+# cancellation terms from get_details barely move within a few seconds.
+# Plain dicts with monotonic timestamps rather than a cachetools dependency,
+# with a per-key lock for singleflight so concurrent sessions asking for
+# the same thing issue one Resy call.
+_VENUE_CACHE: dict[str, tuple[float, list]] = {}
+_VENUE_TTL = 300.0  # seconds
+_DETAILS_CACHE: dict[tuple, tuple[float, dict]] = {}
+_DETAILS_TTL = 10.0  # short: book_tokens inside expire quickly
+_CACHE_MAX = 2048
+_cache_locks: dict = {}  # cache key → asyncio.Lock
+
+
+async def _cached_fetch(cache: dict, key, ttl: float, fetch):
+    """Return cache[key] if fresh, else await fetch() once per key."""
+    hit = cache.get(key)
+    if hit and time.monotonic() - hit[0] < ttl:
+        return hit[1]
+    lock = _cache_locks.setdefault(key, asyncio.Lock())
+    async with lock:
+        try:
+            hit = cache.get(key)
+            if hit and time.monotonic() - hit[0] < ttl:
+                return hit[1]
+            value = await fetch()
+            cache[key] = (time.monotonic(), value)
+            if len(cache) > _CACHE_MAX:
+                cutoff = time.monotonic() - ttl
+                for stale in [k for k, (ts, _) in cache.items() if ts < cutoff]:
+                    del cache[stale]
+            return value
+        finally:
+            _cache_locks.pop(key, None)
+
+
+# ---------------------------------------------------------------------------
+# Time parsing helper
+# ---------------------------------------------------------------------------
+
+def _parse_hhmm(time_str: str) -> str | None:
+    """Extract HH:MM (24h) from various time formats."""
+    s = time_str.strip()
+    # "2026-03-09 22:00:00" → take time part
+    if " " in s:
+        _, time_part = s.rsplit(" ", 1)
+        if ":" in time_part:
+            parts = time_part.split(":")
+            return f"{parts[0]}:{parts[1]}"
+    # "22:00:00" or "22:00" (no AM/PM)
+    upper = s.upper()
+    if ":" in s and "AM" not in upper and "PM" not in upper:
+        parts = s.split(":")
+        return f"{parts[0]}:{parts[1]}"
+    # "10:00 PM", "9.45pm", "5pm", "9:15 AM", etc.
+    for suffix in ("PM", "AM"):
+        if suffix in upper:
+            raw = upper.replace(suffix, "").strip().rstrip(".")
+            raw = raw.replace(".", ":")  # "9.45" → "9:45"
+            parts = raw.split(":")
+            try:
+                hour = int(parts[0])
+                minute = int(parts[1]) if len(parts) > 1 else 0
+            except ValueError:
+                return None
+            if suffix == "PM" and hour != 12:
+                hour += 12
+            elif suffix == "AM" and hour == 12:
+                hour = 0
+            return f"{hour:02d}:{minute:02d}"
+    return None
+
+
+class ChatSession:
+    def __init__(self, resy_client: ResyClient, history: list | None = None):
+        self.resy = resy_client
+
+        # The Gemini chat object is not reentrant: serialize whole turns so
+        # concurrent messages can't interleave tool rounds.
+        self._chat_lock = asyncio.Lock()
+
+        # Server-side state — Gemini never sees config tokens or book tokens
+        self._slot_cache: dict[str, Slot] = {}   # start_time → projected slot
+        self._venue_context: dict | None = None   # venue_id, venue_name, party_size, date
+        self._pending_booking: dict | None = None # config_token, time, details (terms only)
+        self._pending_watch: dict | None = None   # terms + venue_context for confirm_watch
+        self._last_booking: dict | None = None    # saved after confirm for calendar on demand
+        self._pending_calendars: list[tuple[str, str]] = []  # (cal_id, label) to send
+        self._reservation_tokens: dict[str, dict] = {}  # resy_token → reservation info
+
+        self.client = _get_genai_client()
+        self.chat = self.client.chats.create(
+            model="gemini-2.0-flash",
+            config=_config_for(date.today().isoformat()),
+            history=history,
+        )
+
+    # ------------------------------------------------------------------
+    # Serialization — lets sessions live in an external store (Redis) so
+    # multiple uvicorn workers can serve the same user
+    # ------------------------------------------------------------------
+
+    def export_state(self) -> dict:
+        """Dump chat history + server-side context as a JSON-safe dict."""
+        history = [
+            c.model_dump(mode="json", exclude_none=True)
+            for c in self.chat.get_history()
+        ]
+        return {
+            "history": history,
+            "slot_cache": {k: s.raw for k, s in self._slot_cache.items()},
+            "venue_context": self._venue_context,
+            "pending_booking": self._pending_booking,
+            "pending_watch": self._pending_watch,
+            "last_booking": self._last_booking,
+            "reservation_tokens": self._reservation_tokens,
+        }
+
+    @classmethod
+    def from_state(cls, resy_client: ResyClient, state: dict) -> "ChatSession":
+        """Rebuild a session from an export_state() dict."""
+        history = [
+            types.Content.model_validate(c) for c in state.get("history", [])
+        ]
+        session = cls(resy_client, history=history or None)
+        session._slot_cache = {
+            k: slot_from_raw(r) for k, r in (state.get("slot_cache") or {}).items()
+        }
+        session._venue_context = state.get("venue_context")
+        session._pending_booking = state.get("pending_booking")
+        session._pending_watch = state.get("pending_watch")
+        session._last_booking = state.get("last_booking")
+        session._reservation_tokens = state.get("reservation_tokens") or {}
+        return session
+
+    # ------------------------------------------------------------------
+    # Slot lookup
+    # ------------------------------------------------------------------
+
+    def _resolve_slot(self, requested_time: str) -> Slot | None:
+        """Find a cached slot matching the requested time (any format)."""
+        # Exact match first
+        if requested_time in self._slot_cache:
+            return self._slot_cache[requested_time]
+        # Fuzzy match by HH:MM
+        req_hhmm = _parse_hhmm(requested_time)
+        if req_hhmm:
+            for cached_time, cached_slot in self._slot_cache.items():
+                if _parse_hhmm(cached_time) == req_hhmm:
+                    return cached_slot
+        return None
+
+    # ------------------------------------------------------------------
+    # Tool execution
+    # ------------------------------------------------------------------
+
+    async def _execute_tool(self, tool_name: str, tool_input: dict) -> dict:
+        try:
+            if tool_name == "search_restaurant":
+                query = tool_input["query"]
+                venues = await _cached_fetch(
+                    _VENUE_CACHE, query.strip().lower(), _VENUE_TTL,
+                    lambda: self.resy.search_venues(query),
+                )
+                if not venues:
+                    return {"error": "No restaurants found matching that search."}
+                return {"venues": venues}
+
+            elif tool_name == "find_slots":
+                venue_id = int(tool_input["venue_id"])
+                party_size = int(tool_input.get("party_size", 2))
+                day = tool_input["date"]
+                venue_name = tool_input.get("venue_name", "Unknown")
+
+                self._venue_context = {
+                    "venue_id": venue_id,
+                    "venue_name": venue_name,
+                    "party_size": party_size,
+                    "date": day,
+                }
+
+                slots = await self.resy.find_slots(venue_id, party_size, day)
+                if not slots:
+                    return {"error": "No available time slots found for that date."}
+
+                self._slot_cache = {}
+                simplified = []
+                for s in slots:
+                    start = s.start or "unknown"
+                    self._slot_cache[start] = s
+                    simplified.append({
+                        "time": start,
+                        "type": s.type,
+                    })
+                return {"slots": simplified}
+
+            elif tool_name == "prepare_booking":
+                if not self._venue_context:
+                    return {"error": "No venue context. Call find_slots first."}
+
+                requested_time = tool_input.get("time", "")
+                slot = self._resolve_slot(requested_time)
+                if not slot:
+                    available = list(self._slot_cache.keys())
+                    return {
+                        "error": f"Time '{requested_time}' not found in available slots. "
+                        f"Available: {available}"
+                    }
+
+                ctx = self._venue_context
+                config_token = slot.token
+                details = await _cached_fetch(
+                    _DETAILS_CACHE,
+                    (config_token, ctx["date"], ctx["party_size"]),
+                    _DETAILS_TTL,
+                    lambda: self.resy.get_details(
+                        config_token, ctx["date"], ctx["party_size"],
+                    ),
+                )
+
+                if not details["book_token"]:
+                    return {"error": "Could not get a booking token. The slot may no longer be available."}
+
+                # Store config_token (not book_token) so confirm_booking can
+                # re-fetch a fresh book_token right before booking.
+                # This avoids the 412 PRECONDITION FAILED error caused by
+                # expired book_tokens.
+                self._pending_booking = {
+                    "config_token": config_token,
+                    "time": requested_time,
+                    "terms": {
+                        "cancellation_policy": details.get("cancellation_policy"),
+                        "cancellation_fee": details.get("cancellation_fee"),
+                        "cancellation_deadline": details.get("cancellation_deadline"),
+                        "payment_type": details.get("payment_type"),
+                        "payment_total": details.get("payment_total"),
+                    },
+                }
+
+                return {
+                    "status": "ready",
+                    "message": "Present these terms to the user. Do NOT call confirm_booking until they agree.",
+                    "cancellation_policy": details.get("cancellation_policy"),
+                    "cancellation_fee": details.get("cancellation_fee"),
+                    "cancellation_deadline": details.get("cancellation_deadline"),
+                    "payment_type": details.get("payment_type"),
+                    "payment_total": details.get("payment_total"),
+                }
+
+            elif tool_name == "confirm_booking":
+                if not self._pending_booking:
+                    return {"error": "No pending booking. Call prepare_booking first."}
+                if not self._venue_context:
+                    return {"error": "No venue context. Start over with find_slots."}
+
+                pending = self._pending_booking
+                ctx = self._venue_context
+
+                # Re-fetch a fresh book_token right before booking.
+                # Book tokens expire quickly, so we can't reuse the one
+                # from prepare_booking — that causes 412 errors.
+                try:
+                    fresh_details = await self.resy.get_details(
+                        pending["config_token"], ctx["date"], ctx["party_size"],
+                    )
+                except Exception as e:
+                    log.exception("Failed to refresh booking details")
+                    return {"error": f"Could not refresh booking details: {e}"}
+
+                book_token = fresh_details.get("book_token")
+                payment_method_id = fresh_details.get("payment_method_id")
+
+                if not book_token:
+                    return {"error": "The slot is no longer available. Try picking another time."}
+
+                try:
+                    result = await self.resy.book(book_token, payment_method_id)
+                except ResyBookingConflict as e:
+                    log.warning("Booking conflict: %s", e)
+                    return {"error": str(e)}
+                except Exception as e:
+                    log.exception("Booking failed")
+                    return {"error": f"Booking failed: {e}"}
+
+                resy_token = result.get("resy_token", "N/A")
+
+                booked_iso = datetime.now().isoformat()
+                await log_entry_async({
+                    "status": "booked",
+                    "source": "bot",
+                    "venue": ctx["venue_name"],
+                    "venue_id": ctx["venue_id"],
+                    "date": ctx["date"],
+                    "time": pending["time"],
+                    "party_size": ctx["party_size"],
+                    "confirmation_token": resy_token,
+                    "cancellation_policy": pending["terms"].get("cancellation_policy"),
+                    "cancellation_deadline": pending["terms"].get("cancellation_deadline"),
+                    "cancellation_fee": pending["terms"].get("cancellation_fee"),
+                    "booked_at": booked_iso,
+                    "created_at": booked_iso,
+                })
+
+                result_for_gemini = {"result": "Reservation confirmed!"}
+
+                # Create calendar event for the reservation itself
+                try:
+                    res_cal_id = create_reservation_event(
+                        venue_name=ctx["venue_name"],
+                        reservation_date=ctx["date"],
+                        reservation_time=pending["time"],
+                        party_size=ctx["party_size"],
+                    )
+                    self._pending_calendars.append((res_cal_id, "reservation"))
+                    result_for_gemini["reservation_calendar_created"] = True
+                except Exception:
+                    log.exception("Failed to create reservation calendar event")
+
+                # Create calendar reminder for cancellation deadline
+                deadline = pending["terms"].get("cancellation_deadline")
+                if deadline:
+                    try:
+                        cancel_cal_id = create_cancellation_reminder(
+                            venue_name=ctx["venue_name"],
+                            deadline_utc=deadline,
+                            reservation_date=ctx["date"],
+                            reservation_time=pending["time"],
+                            party_size=ctx["party_size"],
+                        )
+                        self._pending_calendars.append((cancel_cal_id, "cancellation"))
+                        result_for_gemini["cancellation_reminder_created"] = True
+                    except Exception:
+                        log.exception("Failed to create cancellation reminder")
+
+                # Save for on-demand calendar creation
+                self._last_booking = {
+                    "venue_name": ctx["venue_name"],
+                    "date": ctx["date"],
+                    "time": pending["time"],
+                    "party_size": ctx["party_size"],
+                    "cancellation_deadline": deadline,
+                }
+                self._pending_booking = None
+                return result_for_gemini
+
+            elif tool_name == "create_calendar_reminder":
+                if not self._last_booking:
+                    return {"error": "No recent booking found. Book a reservation first."}
+                deadline = self._last_booking.get("cancellation_deadline")
+                if not deadline:
+                    return {"error": "This booking has no cancellation deadline."}
+                booking = self._last_booking
+                cal_id = create_cancellation_reminder(
+                    venue_name=booking["venue_name"],
+                    deadline_utc=deadline,
+                    reservation_date=booking["date"],
+                    reservation_time=booking["time"],
+                    party_size=booking["party_size"],
+                )
+                self._pending_calendars.append((cal_id, "cancellation"))
+                return {"result": "Calendar reminder created. A download link will be sent to you."}
+
+            elif tool_name == "prepare_watch":
+                if not self._venue_context:
+                    return {"error": "No venue context. Call find_slots first."}
+
+                ctx = self._venue_context
+                requested_time = tool_input.get("time", "")
+
+                # Find a config_token to fetch terms — use requested time or any cached slot
+                slot = None
+                if requested_time:
+                    slot = self._resolve_slot(requested_time)
+                if not slot and self._slot_cache:
+                    slot = next(iter(self._slot_cache.values()))
+
+                if not slot:
+                    # No cached slots — fetch fresh ones just for terms lookup
+                    try:
+                        fresh_slots = await self.resy.find_slots(
+                            ctx["venue_id"], ctx["party_size"], ctx["date"],
+                        )
+                    except Exception as e:
+                        return {"error": f"Could not fetch slots for terms lookup: {e}"}
+                    if not fresh_slots:
+                        return {
+                            "error": "No slots available at all for this venue/date. "
+                            "Cannot look up cancellation terms.",
+                        }
+                    slot = fresh_slots[0]
+
+                config_token = slot.token
+                try:
+                    details = await _cached_fetch(
+                        _DETAILS_CACHE,
+                        (config_token, ctx["date"], ctx["party_size"]),
+                        _DETAILS_TTL,
+                        lambda: self.resy.get_details(
+                            config_token, ctx["date"], ctx["party_size"],
+                        ),
+                    )
+                except Exception as e:
+                    return {"error": f"Could not fetch cancellation terms: {e}"}
+
+                terms = {
+                    "cancellation_policy": details.get("cancellation_policy"),
+                    "cancellation_fee": details.get("cancellation_fee"),
+                    "cancellation_deadline": details.get("cancellation_deadline"),
+                    "payment_type": details.get("payment_type"),
+                    "payment_total": details.get("payment_total"),
+                }
+
+                self._pending_watch = {
+                    "terms": terms,
+                    "venue_context": dict(ctx),
+                }
+
+                return {
+                    "status": "ready",
+                    "message": (
+                        "Present these terms to the user. Explain that once the watch "
+                        "is armed, the bot will auto-book instantly when a match is "
+                        "found. Wait for confirmation before calling confirm_watch."
+                    ),
+                    "cancellation_policy": terms["cancellation_policy"],
+                    "cancellation_fee": terms["cancellation_fee"],
+                    "cancellation_deadline": terms["cancellation_deadline"],
+                    "payment_type": terms["payment_type"],
+                    "payment_total": terms["payment_total"],
+                }
+
+            elif tool_name == "confirm_watch":
+                if not self._pending_watch:
+                    return {"error": "No pending watch. Call prepare_watch first."}
+
+                pw = self._pending_watch
+                ctx = pw["venue_context"]
+                terms = pw["terms"]
+                preferred_times = list(tool_input.get("preferred_times", []))
+                snipe_at = tool_input.get("snipe_at")
+                dates = list(tool_input.get("dates", [])) or [ctx["date"]]
+
+                self._pending_watch = None
+
+                params = {
+                    "venue_id": ctx["venue_id"],
+                    "venue_name": ctx["venue_name"],
+                    "party_size": ctx["party_size"],
+                    "date": ctx["date"],
+                    "dates": dates,
+                    "preferred_times": preferred_times,
+                    "auto_book": True,
+                    "terms": terms,
+                }
+                if snipe_at:
+                    params["snipe_at"] = snipe_at
+
+                return {"__watch__": True, "params": params}
+
+            elif tool_name == "get_log":
+                entries = await load_log_async()
+                if not entries:
+                    return {"result": "No reservation log entries yet."}
+                return {"entries": entries}
+
+            elif tool_name == "list_reservations":
+                reservations = await self.resy.list_reservations()
+                if not reservations:
+                    return {"result": "You don't have any reservations."}
+                # Only show upcoming ones (today or later)
+                today = date.today().isoformat()
+                upcoming = [r for r in reservations if (r.get("day") or "") >= today]
+                if not upcoming:
+                    return {"result": "You don't have any upcoming reservations."}
+                # Store tokens for cancel lookups
+                self._reservation_tokens = {
+                    r["resy_token"]: r for r in upcoming
+                }
+                # Return simplified info to Gemini (no tokens exposed)
+                simplified = []
+                for r in upcoming:
+                    simplified.append({
+                        "venue_name": r["venue_name"],
+                        "day": r["day"],
+                        "time_slot": r["time_slot"],
+                        "num_seats": r["num_seats"],
+                        "cancel_allowed": r["cancel_allowed"],
+                        "cancellation_policy": r["cancellation_policy"],
+                        "resy_token": r["resy_token"],
+                    })
+                return {"reservations": simplified}
+
+            elif tool_name == "cancel_reservation":
+                resy_token = tool_input.get("resy_token", "")
+                if not resy_token:
+                    return {"error": "Missing resy_token. Call list_reservations first."}
+                try:
+                    result = await self.resy.cancel(resy_token)
+                except Exception as e:
+                    log.exception("Cancel failed")
+                    return {"error": f"Cancellation failed: {e}"}
+
+                # Track cancellation in log
+                entries = await load_log_async()
+                matched = None
+                for entry in entries:
+                    if (entry and entry.get("status") == "booked"
+                            and entry.get("confirmation_token") == resy_token):
+                        matched = entry
+                        break
+                if matched and matched.get("created_at"):
+                    await update_entry_async(matched["created_at"], {
+                        "status": "cancelled",
+                        "source": "bot",
+                        "cancelled_at": datetime.now().isoformat(),
+                    })
+                else:
+                    # Fallback: append a new cancelled entry
+                    venue_info = (self._reservation_tokens or {}).get(resy_token, {})
+                    cancelled_iso = datetime.now().isoformat()
+                    await log_entry_async({
+                        "status": "cancelled",
+                        "source": "bot",
+                        "venue": venue_info.get("venue_name", "Unknown"),
+                        "date": venue_info.get("day", ""),
+                        "time": venue_info.get("time_slot", ""),
+                        "party_size": venue_info.get("num_seats", ""),
+                        "cancelled_at": cancelled_iso,
+                        "created_at": cancelled_iso,
+                    })
+
+                return {"result": "Reservation cancelled successfully."}
+
+            else:
+                return {"error": f"Unknown tool: {tool_name}"}
+
+        except Exception as e:
+            log.exception("Tool %s failed", tool_name)
+            return {"error": str(e)}
+
+    # ------------------------------------------------------------------
+    # Message processing
+    # ------------------------------------------------------------------
+
+    def _extract_parts(self, response) -> tuple[list, list[str]]:
+        """Safely extract function calls and text from a Gemini response."""
+        function_calls = []
+        texts = []
+        try:
+            candidates = response.candidates or []
+            if not candidates:
+                return [], []
+            parts = candidates[0].content.parts or []
+            for part in parts:
+                if part.function_call:
+                    function_calls.append(part.function_call)
+                elif part.text:
+                    texts.append(part.text)
+        except (AttributeError, IndexError) as e:
+            log.warning("Could not parse Gemini response: %s", e)
+        return function_calls, texts
+
+    async def process_message(self, user_text: str) -> list[dict]:
+        """Process a user message. Returns list of event dicts:
+          {"type": "text", "text": "..."}
+          {"type": "watch", "params": {...}}
+          {"type": "calendar", "cal_id": "..."}
+        """
+        events: list[dict] = []
+        self._pending_calendars = []
+
+        async with self._chat_lock:
+            await self._run_turn(user_text, events)
+
+        for cal_id, label in self._pending_calendars:
+            events.append({"type": "calendar", "cal_id": cal_id, "label": label})
+
+        return events
+
+    async def _run_turn(self, user_text: str, events: list[dict]) -> None:
+        """Drive one conversation turn, executing tool calls as requested.
+
+        The blocking Vertex AI round-trips run in a thread so they never
+        stall the event loop.
+        """
+        response = await asyncio.to_thread(self.chat.send_message, user_text)
+
+        max_rounds = 10  # safety limit
+        for _ in range(max_rounds):
+            function_calls, texts = self._extract_parts(response)
+            for t in texts:
+                events.append({"type": "text", "text": t})
+
+            if not function_calls:
+                break
+
+            function_responses = []
+            for fc in function_calls:
+                log.info("Gemini called %s(%s)", fc.name, dict(fc.args))
+                result = await self._execute_tool(fc.name, dict(fc.args))
+
+                if isinstance(result, dict) and result.get("__watch__"):
+                    params = result["params"]
+                    events.append({"type": "watch", "params": params})
+                    dates_str = ", ".join(params.get("dates", [params["date"]]))
+                    times_str = ", ".join(params["preferred_times"])
+                    snipe_note = ""
+                    if params.get("snipe_at"):
+                        snipe_note = f" Snipe mode active — will poll aggressively starting at {params['snipe_at']}."
+                    result = {
+                        "result": f"Watch armed with auto-book! Watching for "
+                        f"{times_str} at {params['venue_name']} on {dates_str}."
+                        f"{snipe_note} I'll book instantly when a match opens up."
+                    }
+
+                function_responses.append(
+                    types.Part.from_function_response(name=fc.name, response=result)
+                )
+
+            try:
+                response = await asyncio.to_thread(self.chat.send_message, function_responses)
+            except Exception:
+                log.exception("Gemini send_message failed after tool execution")
+                events.append({"type": "text", "text": "Sorry, I had trouble processing that. Please try again."})
+                break
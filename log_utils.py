@@ -1,22 +1,214 @@
-"""Shared logging utilities for reservation bot."""
-
-import json
-from pathlib import Path
-
-LOG_FILE = Path(__file__).parent / "reservations_log.json"
-
-
-def load_log():
-    if LOG_FILE.exists():
-        return json.loads(LOG_FILE.read_text())
-    return []
-
-
-def save_log(entries):
-    LOG_FILE.write_text(json.dumps(entries, indent=2))
-
-
-def log_entry(entry):
-    entries = load_log()
-    entries.append(entry)
-    save_log(entries)
+"""Shared logging utilities for reservation bot."""
+
+import asyncio
+import os
+from pathlib import Path
+
+import orjson
+
+# Append-only JSON Lines log. Each line is a full entry keyed by its
+# created_at; a later line carrying an already-seen created_at is a status
+# update folded into that entry on read. Appends are O(1) regardless of
+# log size; the file is only rewritten on explicit compaction (save_log).
+LOG_FILE = Path(__file__).parent / "reservations_log.jsonl"
+_LEGACY_LOG_FILE = Path(__file__).parent / "reservations_log.json"
+
+# In-memory cache of the folded log. Async and sync callers share this list,
+# so the file is read at most once per process and the event loop never
+# blocks on disk for reads.
+_log_cache: list | None = None
+_entry_index: dict[str, dict] = {}  # created_at → entry, for O(1) updates
+_flush_lock = asyncio.Lock()  # serializes flushes so writes never interleave
+_flush_task: asyncio.Task | None = None
+_pending_records: list[dict] = []  # records awaiting an async append
+_FLUSH_DELAY = 0.5  # seconds — debounce window to coalesce bursts of appends
+_append_handle = None  # cached "ab" handle — one open() per process, not per write
+
+# Durability policy for appends, read once from the environment:
+#   "flush" (default) — flush every batch, fsync only batches that record a
+#       booking (the one transition worth surviving a crash; a dropped
+#       "watching" or "stopped" line is harmless)
+#   "fsync" — flush and fsync every batch
+#   "none"  — leave flushing to the OS
+_PERSIST_POLICY = os.getenv("PERSIST_POLICY", "flush").lower()
+_delta_count = 0  # update lines in the file beyond the folded entries
+_COMPACT_THRESHOLD = 512  # delta lines tolerated before rewriting compact
+
+
+def _read_file() -> list:
+    """Load and fold the JSONL log, migrating the legacy .json list once."""
+    global _delta_count
+    entries: list = []
+    by_key: dict[str, dict] = {}
+
+    def _fold(record: dict) -> None:
+        key = record.get("created_at")
+        existing = by_key.get(key) if key else None
+        if existing is not None:
+            existing.update(
+                {k: v for k, v in record.items() if k != "created_at"}
+            )
+        else:
+            entries.append(record)
+            if key:
+                by_key[key] = record
+
+    if LOG_FILE.exists():
+        lines = 0
+        for line in LOG_FILE.read_bytes().splitlines():
+            if line:
+                lines += 1
+                _fold(orjson.loads(line))
+        _delta_count = lines - len(entries)
+    elif _LEGACY_LOG_FILE.exists():
+        for record in orjson.loads(_LEGACY_LOG_FILE.read_bytes()):
+            if record:
+                _fold(record)
+        _write_file(entries)  # materialize the migrated log as JSONL
+    return entries
+
+
+def _write_file(entries: list) -> None:
+    global _append_handle, _delta_count
+    if _append_handle is not None:
+        _append_handle.close()
+        _append_handle = None
+    LOG_FILE.write_bytes(b"".join(orjson.dumps(e) + b"\n" for e in entries))
+    _delta_count = 0
+
+
+def _append_records(records: list[dict]) -> None:
+    global _append_handle
+    if _append_handle is None:
+        _append_handle = LOG_FILE.open("ab")
+    _append_handle.write(b"".join(orjson.dumps(r) + b"\n" for r in records))
+    if _PERSIST_POLICY == "none":
+        return
+    _append_handle.flush()
+    if _PERSIST_POLICY == "fsync" or any(
+        r.get("status") == "booked" for r in records
+    ):
+        os.fsync(_append_handle.fileno())
+
+
+def _maybe_compact() -> None:
+    """Rewrite the log compact once enough update lines have accumulated."""
+    if _delta_count >= _COMPACT_THRESHOLD and _log_cache is not None:
+        _write_file(_log_cache)
+
+
+def _reindex(entries: list) -> None:
+    _entry_index.clear()
+    for e in entries:
+        if e and e.get("created_at"):
+            _entry_index[e["created_at"]] = e
+
+
+def _merge_into_cache(created_at: str, updates: dict) -> None:
+    entry = _entry_index.get(created_at)
+    if entry is not None:
+        entry.update(updates)
+
+
+# ---------------------------------------------------------------------------
+# Sync API — used by the CLI (main.py), where blocking on disk is fine
+# ---------------------------------------------------------------------------
+
+def load_log():
+    global _log_cache
+    if _log_cache is None:
+        _log_cache = _read_file()
+        _reindex(_log_cache)
+    return _log_cache
+
+
+def save_log(entries):
+    """Replace the log wholesale (compaction) — appends are the norm."""
+    global _log_cache
+    _log_cache = entries
+    _reindex(entries)
+    _write_file(entries)
+
+
+def log_entry(entry):
+    load_log().append(entry)
+    if entry.get("created_at"):
+        _entry_index[entry["created_at"]] = entry
+    _append_records([entry])
+
+
+def update_entry(created_at: str, updates: dict):
+    """Update the entry keyed by created_at via an O(1) append."""
+    global _delta_count
+    load_log()
+    _merge_into_cache(created_at, updates)
+    _append_records([{"created_at": created_at, **updates}])
+    _delta_count += 1
+    _maybe_compact()
+
+
+# ---------------------------------------------------------------------------
+# Async API — used by the FastAPI handlers. Reads hit the cache; appends are
+# debounced and flushed off-loop so handlers never stall on file I/O.
+# ---------------------------------------------------------------------------
+
+async def load_log_async() -> list:
+    global _log_cache
+    if _log_cache is None:
+        _log_cache = await asyncio.to_thread(_read_file)
+        _reindex(_log_cache)
+    return _log_cache
+
+
+async def log_entry_async(entry: dict) -> None:
+    (await load_log_async()).append(entry)
+    if entry.get("created_at"):
+        _entry_index[entry["created_at"]] = entry
+    _pending_records.append(entry)
+    _schedule_flush()
+
+
+async def update_entry_async(created_at: str, updates: dict) -> None:
+    """Async variant of update_entry — merge in memory, append a delta line."""
+    global _delta_count
+    await load_log_async()
+    _merge_into_cache(created_at, updates)
+    _pending_records.append({"created_at": created_at, **updates})
+    _delta_count += 1
+    _schedule_flush()
+
+
+def _schedule_flush() -> None:
+    global _flush_task
+    if _flush_task is None or _flush_task.done():
+        _flush_task = asyncio.create_task(_flush())
+
+
+def _flush_sync(records: list[dict]) -> None:
+    _append_records(records)
+    _maybe_compact()
+
+
+async def _flush() -> None:
+    await asyncio.sleep(_FLUSH_DELAY)
+    async with _flush_lock:
+        # Loop until the queue is drained: a record appended while the
+        # previous batch was on the writer thread sees a not-yet-done task
+        # and schedules nothing, so exiting after one batch would strand
+        # it in memory until some unrelated later append.
+        while _pending_records:
+            records, _pending_records[:] = list(_pending_records), []
+            await asyncio.to_thread(_flush_sync, records)
+
+
+async def flush_pending() -> None:
+    """Write any pending records immediately — called at server shutdown.
+
+    Without this, a clean SIGTERM drops whatever landed inside the
+    debounce window, including booked entries the persist policy
+    promises to fsync.
+    """
+    async with _flush_lock:
+        while _pending_records:
+            records, _pending_records[:] = list(_pending_records), []
+            await asyncio.to_thread(_flush_sync, records)
@@ -1,320 +1,446 @@
-"""Interactive Resy reservation CLI."""
-
-import os
-import sys
-import time
-from datetime import datetime
-
-from dotenv import load_dotenv
-from resy_api import ResyClient
-from log_utils import load_log, save_log, log_entry
-
-
-def show_log():
-    entries = load_log()
-    if not entries:
-        print("No entries yet.")
-        return
-
-    watching = [e for e in entries if e["status"] == "watching"]
-    booked = [e for e in entries if e["status"] == "booked"]
-    cancelled = [e for e in entries if e["status"] == "stopped"]
-
-    if watching:
-        print("\n--- Watching for cancellations ---")
-        for e in watching:
-            times = ", ".join(e["preferred_times"])
-            print(f"  {e['venue']} | {e['date']} | party of {e['party_size']} | looking for: {times}")
-            print(f"    started: {e['created_at']}")
-
-    if booked:
-        print("\n--- Confirmed reservations ---")
-        for e in booked:
-            print(f"  {e['venue']} | {e['date']} | {e.get('time', 'N/A')} | party of {e['party_size']}")
-            token = e.get("confirmation_token", "N/A")
-            print(f"    confirmed: {e.get('booked_at', 'N/A')} | token: {token}")
-
-    if cancelled:
-        print("\n--- Stopped watches ---")
-        for e in cancelled:
-            times = ", ".join(e["preferred_times"])
-            print(f"  {e['venue']} | {e['date']} | was looking for: {times}")
-            print(f"    stopped: {e.get('stopped_at', 'N/A')}")
-
-    if not watching and not booked and not cancelled:
-        print("No entries yet.")
-    print()
-
-
-def search_restaurant(client):
-    """Search for a restaurant, allowing retries for typos."""
-    while True:
-        query = input("\nSearch for a restaurant: ").strip()
-        if not query:
-            print("No query entered.")
-            return None
-
-        try:
-            venues = client.search_venues(query)
-        except Exception as e:
-            print(f"Search failed: {e}")
-            return None
-
-        if not venues:
-            retry = input("No results found. Try a different search? (y/n): ").strip().lower()
-            if retry == "y":
-                continue
-            return None
-
-        print("\nResults:")
-        for i, v in enumerate(venues, 1):
-            cuisine = ", ".join(v["cuisine"]) if v["cuisine"] else "N/A"
-            location = v["location"]
-            neighborhood = v["neighborhood"]
-            loc_display = f"{neighborhood}, {location}" if neighborhood else location
-            print(f"  {i}. {v['name']} — {loc_display} ({cuisine})")
-
-        print(f"  {len(venues) + 1}. None of these — search again")
-
-        choice = input("\nSelect a restaurant (number): ").strip()
-        try:
-            idx = int(choice) - 1
-        except ValueError:
-            print("Invalid selection.")
-            return None
-
-        if idx == len(venues):
-            continue
-
-        if idx < 0 or idx >= len(venues):
-            print("Invalid selection.")
-            return None
-
-        return venues[idx]
-
-
-def watch_for_cancellations(client, venue, party_size, day):
-    """Poll for preferred time slots and auto-book when one opens up."""
-    raw = input("\nEnter preferred time(s), comma-separated (e.g. 14:30, 15:00): ").strip()
-    if not raw:
-        print("No times entered.")
-        return
-
-    preferred = [t.strip() for t in raw.split(",") if t.strip()]
-    print(f"\nWatching for: {', '.join(preferred)}")
-    print("Polling every 60 seconds. Press Ctrl+C to stop.\n")
-
-    watch_entry = {
-        "status": "watching",
-        "venue": venue["name"],
-        "venue_id": venue["id"],
-        "date": day,
-        "party_size": party_size,
-        "preferred_times": preferred,
-        "created_at": datetime.now().isoformat(),
-    }
-    log_entry(watch_entry)
-
-    poll_interval = 60
-
-    try:
-        while True:
-            now = datetime.now().strftime("%H:%M:%S")
-            try:
-                slots = client.find_slots(venue["id"], party_size, day)
-            except Exception as e:
-                print(f"[{now}] Poll error: {e}")
-                time.sleep(poll_interval)
-                continue
-
-            # Check each slot for a preferred-time match
-            matched_slot = None
-            for slot in slots:
-                start = slot.get("date", {}).get("start", "")
-                # start looks like "2026-03-08 14:30:00"
-                for pref in preferred:
-                    if f" {pref}" in start:
-                        matched_slot = slot
-                        break
-                if matched_slot:
-                    break
-
-            if not matched_slot:
-                available = [s.get("date", {}).get("start", "?") for s in slots]
-                print(f"[{now}] No match. Available: {', '.join(available) if available else 'none'}")
-                time.sleep(poll_interval)
-                continue
-
-            # --- Match found — auto-book ---
-            match_time = matched_slot.get("date", {}).get("start", "unknown")
-            print(f"\n[{now}] Match found: {match_time}")
-
-            config_id = matched_slot.get("config", {}).get("token")
-            try:
-                details = client.get_details(config_id, day, party_size)
-            except Exception as e:
-                print(f"Failed to get booking details: {e}")
-                return
-
-            book_token = details["book_token"]
-            payment_method_id = details["payment_method_id"]
-
-            if not book_token:
-                print("Could not obtain a booking token.")
-                return
-
-            confirm = input(
-                f"Book {venue['name']} for {party_size} on {day} at {match_time}? (y/n): "
-            ).strip().lower()
-
-            if confirm != "y":
-                print("Skipped. Resuming watch...\n")
-                time.sleep(poll_interval)
-                continue
-
-            try:
-                result = client.book(book_token, payment_method_id)
-                resy_token = result.get("resy_token", "N/A")
-                print(f"\nReservation confirmed! Confirmation token: {resy_token}")
-                # Update log: mark watch as booked
-                entries = load_log()
-                for e in entries:
-                    if e is not None and e.get("venue_id") == venue["id"] and e.get("date") == day and e.get("status") == "watching":
-                        e["status"] = "booked"
-                        e["time"] = match_time
-                        e["confirmation_token"] = resy_token
-                        e["booked_at"] = datetime.now().isoformat()
-                        break
-                save_log(entries)
-            except Exception as e:
-                print(f"\nBooking failed: {e}")
-            return
-
-    except KeyboardInterrupt:
-        # Update log: mark watch as stopped
-        entries = load_log()
-        for e in entries:
-            if e is not None and e.get("venue_id") == venue["id"] and e.get("date") == day and e.get("status") == "watching":
-                e["status"] = "stopped"
-                e["stopped_at"] = datetime.now().isoformat()
-                break
-        save_log(entries)
-        print("\n\nStopped watching. Goodbye!")
-
-
-def main():
-    load_dotenv()
-
-    if "--log" in sys.argv:
-        show_log()
-        return
-
-    api_key = os.getenv("RESY_API_KEY")
-    auth_token = os.getenv("RESY_AUTH_TOKEN")
-
-    if not api_key or not auth_token:
-        print("Error: RESY_API_KEY and RESY_AUTH_TOKEN must be set in .env or environment.")
-        sys.exit(1)
-
-    client = ResyClient(api_key, auth_token)
-
-    # --- Search ---
-    venue = search_restaurant(client)
-    if not venue:
-        return
-
-    # --- Party size & date ---
-    try:
-        party_size = int(input("\nParty size: ").strip())
-    except ValueError:
-        print("Invalid party size.")
-        return
-
-    day = input("Date (YYYY-MM-DD): ").strip()
-
-    # --- Find slots ---
-    try:
-        slots = client.find_slots(venue["id"], party_size, day)
-    except Exception as e:
-        print(f"Failed to fetch time slots: {e}")
-        return
-
-    if not slots:
-        print("No available time slots.")
-        return
-
-    print("\nAvailable times:")
-    for i, slot in enumerate(slots, 1):
-        start = slot.get("date", {}).get("start", "unknown")
-        slot_type = slot.get("config", {}).get("type", "")
-        print(f"  {i}. {start}  ({slot_type})")
-
-    watch_option = len(slots) + 1
-    print(f"  {watch_option}. None of these — watch for a specific time")
-
-    # --- Select slot ---
-    slot_choice = input("\nSelect a time slot (number): ").strip()
-    try:
-        choice_idx = int(slot_choice)
-    except ValueError:
-        print("Invalid selection.")
-        return
-
-    if choice_idx == watch_option:
-        watch_for_cancellations(client, venue, party_size, day)
-        return
-
-    try:
-        selected_slot = slots[choice_idx - 1]
-    except IndexError:
-        print("Invalid selection.")
-        return
-
-    config_id = selected_slot.get("config", {}).get("token")
-    start_time = selected_slot.get("date", {}).get("start", "unknown")
-
-    # --- Get booking details ---
-    try:
-        details = client.get_details(config_id, day, party_size)
-    except Exception as e:
-        print(f"Failed to get booking details: {e}")
-        return
-
-    book_token = details["book_token"]
-    payment_method_id = details["payment_method_id"]
-
-    if not book_token:
-        print("Could not obtain a booking token.")
-        return
-
-    # --- Confirm ---
-    confirm = input(
-        f"\nBook {venue['name']} for {party_size} on {day} at {start_time}? (y/n): "
-    ).strip().lower()
-
-    if confirm != "y":
-        print("Booking cancelled.")
-        return
-
-    # --- Book ---
-    try:
-        result = client.book(book_token, payment_method_id)
-        resy_token = result.get("resy_token", "N/A")
-        print(f"\nReservation confirmed! Confirmation token: {resy_token}")
-        log_entry({
-            "status": "booked",
-            "venue": venue["name"],
-            "venue_id": venue["id"],
-            "date": day,
-            "time": start_time,
-            "party_size": party_size,
-            "confirmation_token": resy_token,
-            "booked_at": datetime.now().isoformat(),
-            "created_at": datetime.now().isoformat(),
-        })
-    except Exception as e:
-        print(f"\nBooking failed: {e}")
-
-
-if __name__ == "__main__":
-    main()
+"""Interactive Resy reservation CLI."""
+
+import asyncio
+import os
+import signal
+import sys
+import threading
+from datetime import datetime
+
+from dotenv import load_dotenv
+from resy_api import ResyClient
+from log_utils import load_log, log_entry, update_entry
+
+
+async def _prompt(text: str) -> str:
+    """Read a line without blocking the event loop.
+
+    input() runs on a throwaway daemon thread rather than the default
+    executor: asyncio.run() joins the executor on shutdown, so a Ctrl-C
+    while a prompt was open would hang the process until the user
+    pressed Enter. A daemon thread is simply abandoned at exit.
+    """
+    loop = asyncio.get_running_loop()
+    future: asyncio.Future = loop.create_future()
+
+    def read():
+        try:
+            line = input(text)
+        except BaseException as e:  # EOFError etc. — surface on the loop
+            result, exc = None, e
+        else:
+            result, exc = line, None
+
+        def resolve():
+            if future.cancelled():
+                return
+            if exc is not None:
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
+
+        try:
+            loop.call_soon_threadsafe(resolve)
+        except RuntimeError:
+            pass  # loop already closed — shutdown raced the prompt
+
+    threading.Thread(target=read, daemon=True, name="prompt").start()
+    return await future
+
+
+async def _prompt_or_stop(text: str, stop: asyncio.Event) -> str | None:
+    """Prompt, but give up immediately (returning None) if stop fires.
+
+    The watch loop's signal handler only sets the stop event; without
+    this race, Ctrl-C at a confirm prompt would look ignored until the
+    user pressed Enter.
+    """
+    prompt_task = asyncio.create_task(_prompt(text))
+    stop_task = asyncio.create_task(stop.wait())
+    done, pending = await asyncio.wait(
+        {prompt_task, stop_task}, return_when=asyncio.FIRST_COMPLETED
+    )
+    for task in pending:
+        task.cancel()
+    return prompt_task.result() if prompt_task in done else None
+
+
+async def _pause(stop: asyncio.Event, seconds: float) -> bool:
+    """Wait out a poll interval; True if the stop signal cut it short."""
+    try:
+        await asyncio.wait_for(stop.wait(), timeout=seconds)
+    except asyncio.TimeoutError:
+        return False
+    return True
+
+
+def _to_minutes(hhmm: str) -> int | None:
+    """"14:30" → minutes since midnight, or None if unparseable."""
+    try:
+        hours, minutes = hhmm.split(":")
+        return int(hours) * 60 + int(minutes)
+    except ValueError:
+        return None
+
+
+def show_log():
+    entries = load_log()
+    if not entries:
+        print("No entries yet.")
+        return
+
+    watching = [e for e in entries if e["status"] == "watching"]
+    booked = [e for e in entries if e["status"] == "booked"]
+    cancelled = [e for e in entries if e["status"] == "stopped"]
+
+    if watching:
+        print("\n--- Watching for cancellations ---")
+        for e in watching:
+            times = ", ".join(e["preferred_times"])
+            print(f"  {e['venue']} | {e['date']} | party of {e['party_size']} | looking for: {times}")
+            print(f"    started: {e['created_at']}")
+
+    if booked:
+        print("\n--- Confirmed reservations ---")
+        for e in booked:
+            print(f"  {e['venue']} | {e['date']} | {e.get('time', 'N/A')} | party of {e['party_size']}")
+            token = e.get("confirmation_token", "N/A")
+            print(f"    confirmed: {e.get('booked_at', 'N/A')} | token: {token}")
+
+    if cancelled:
+        print("\n--- Stopped watches ---")
+        for e in cancelled:
+            times = ", ".join(e["preferred_times"])
+            print(f"  {e['venue']} | {e['date']} | was looking for: {times}")
+            print(f"    stopped: {e.get('stopped_at', 'N/A')}")
+
+    if not watching and not booked and not cancelled:
+        print("No entries yet.")
+    print()
+
+
+async def search_restaurant(client):
+    """Search for a restaurant, allowing retries for typos."""
+    while True:
+        query = (await _prompt("\nSearch for a restaurant: ")).strip()
+        if not query:
+            print("No query entered.")
+            return None
+
+        try:
+            venues = await client.search_venues(query)
+        except Exception as e:
+            print(f"Search failed: {e}")
+            return None
+
+        if not venues:
+            retry = (await _prompt("No results found. Try a different search? (y/n): ")).strip().lower()
+            if retry == "y":
+                continue
+            return None
+
+        print("\nResults:")
+        for i, v in enumerate(venues, 1):
+            cuisine = ", ".join(v["cuisine"]) if v["cuisine"] else "N/A"
+            location = v["location"]
+            neighborhood = v["neighborhood"]
+            loc_display = f"{neighborhood}, {location}" if neighborhood else location
+            print(f"  {i}. {v['name']} — {loc_display} ({cuisine})")
+
+        print(f"  {len(venues) + 1}. None of these — search again")
+
+        choice = (await _prompt("\nSelect a restaurant (number): ")).strip()
+        try:
+            idx = int(choice) - 1
+        except ValueError:
+            print("Invalid selection.")
+            return None
+
+        if idx == len(venues):
+            continue
+
+        if idx < 0 or idx >= len(venues):
+            print("Invalid selection.")
+            return None
+
+        return venues[idx]
+
+
+# Ticks between stdout flushes for the per-poll status line. Writing without
+# flushing keeps a piped stdout (CI log, journald) from syncing once a tick;
+# anything important below still prints (and flushes) immediately.
+_FLUSH_EVERY = 10
+
+
+async def watch_for_cancellations(client, venue, party_size, day, quiet=False):
+    """Poll for preferred time slots and auto-book when one opens up.
+
+    With quiet=True the per-tick "no match" line is suppressed entirely —
+    only matches, errors, and the final state transitions are printed.
+    """
+    raw = (await _prompt("\nEnter preferred time(s), comma-separated (e.g. 14:30, 15:00): ")).strip()
+    if not raw:
+        print("No times entered.")
+        return
+
+    preferred = [t.strip() for t in raw.split(",") if t.strip()]
+    print(f"\nWatching for: {', '.join(preferred)}")
+    print("Polling every 60 seconds. Press Ctrl+C to stop.\n")
+
+    watch_entry = {
+        "status": "watching",
+        "venue": venue["name"],
+        "venue_id": venue["id"],
+        "date": day,
+        "party_size": party_size,
+        "preferred_times": preferred,
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+    }
+    log_entry(watch_entry)
+
+    poll_interval = 60
+
+    # Encode preferred times as integer minutes-since-midnight once, so the
+    # per-tick match is an arithmetic set probe per slot — no string
+    # assembly or substring scans.
+    preferred_mins = frozenset(
+        m for m in (_to_minutes(p) for p in preferred) if m is not None
+    )
+
+    # Ctrl-C sets an event instead of raising mid-loop, so the poll wait
+    # ends immediately and the "stopped" transition runs exactly once
+    # below — never from inside an interruptible exception handler.
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGINT, stop.set)
+    loop.add_signal_handler(signal.SIGTERM, stop.set)
+
+    ticks = 0
+    try:
+        while not stop.is_set():
+            t = datetime.now()
+            # f-string formatting skips strftime's locale-aware formatter
+            now = f"{t.hour:02d}:{t.minute:02d}:{t.second:02d}"
+            try:
+                slots = await client.find_slots(venue["id"], party_size, day)
+            except Exception as e:
+                print(f"[{now}] Poll error: {e}")
+                if await _pause(stop, poll_interval):
+                    break
+                continue
+
+            matched_slot = next(
+                (
+                    s for s in slots
+                    # s.start looks like "2026-03-08 14:30:00"
+                    if len(s.start) >= 16
+                    and int(s.start[11:13]) * 60 + int(s.start[14:16]) in preferred_mins
+                ),
+                None,
+            )
+
+            if not matched_slot:
+                if not quiet:
+                    available = [s.start or "?" for s in slots]
+                    sys.stdout.write(
+                        f"[{now}] No match. Available: "
+                        f"{', '.join(available) if available else 'none'}\n"
+                    )
+                    ticks += 1
+                    if ticks % _FLUSH_EVERY == 0:
+                        sys.stdout.flush()
+                if await _pause(stop, poll_interval):
+                    break
+                continue
+
+            # --- Match found — auto-book ---
+            sys.stdout.flush()  # drain buffered status lines before the prompt
+            match_time = matched_slot.start or "unknown"
+            print(f"\n[{now}] Match found: {match_time}")
+
+            # Fetch booking details concurrently with the confirm prompt so
+            # the book token is already in hand when the user answers "y" —
+            # one less round-trip while the slot is still claimable.
+            config_id = matched_slot.token
+            details_task = asyncio.create_task(
+                client.get_details(config_id, day, party_size)
+            )
+
+            confirm = await _prompt_or_stop(
+                f"Book {venue['name']} for {party_size} on {day} at {match_time}? (y/n): ",
+                stop,
+            )
+            if confirm is None:  # Ctrl-C while the prompt was open
+                details_task.cancel()
+                break
+            confirm = confirm.strip().lower()
+
+            if confirm != "y":
+                details_task.cancel()
+                print("Skipped. Resuming watch...\n")
+                if await _pause(stop, poll_interval):
+                    break
+                continue
+
+            try:
+                details = await details_task
+            except Exception as e:
+                print(f"Failed to get booking details: {e}")
+                return
+
+            book_token = details["book_token"]
+            payment_method_id = details["payment_method_id"]
+
+            if not book_token:
+                print("Could not obtain a booking token.")
+                return
+
+            try:
+                result = await client.book(book_token, payment_method_id)
+                resy_token = result.get("resy_token", "N/A")
+                print(f"\nReservation confirmed! Confirmation token: {resy_token}")
+                # Mark the watch as booked — keyed update, no log scan
+                update_entry(watch_entry["created_at"], {
+                    "status": "booked",
+                    "time": match_time,
+                    "confirmation_token": resy_token,
+                    "booked_at": datetime.now().isoformat(timespec="seconds"),
+                })
+            except Exception as e:
+                print(f"\nBooking failed: {e}")
+            return
+
+    finally:
+        sys.stdout.flush()
+        loop.remove_signal_handler(signal.SIGINT)
+        loop.remove_signal_handler(signal.SIGTERM)
+
+    # Reached only via the stop signal (or stopping conditions above)
+    update_entry(watch_entry["created_at"], {
+        "status": "stopped",
+        "stopped_at": datetime.now().isoformat(timespec="seconds"),
+    })
+    print("\n\nStopped watching. Goodbye!")
+
+
+async def main():
+    load_dotenv()
+
+    if "--log" in sys.argv:
+        show_log()
+        return
+
+    quiet = "--quiet" in sys.argv
+
+    api_key = os.getenv("RESY_API_KEY")
+    auth_token = os.getenv("RESY_AUTH_TOKEN")
+
+    if not api_key or not auth_token:
+        print("Error: RESY_API_KEY and RESY_AUTH_TOKEN must be set in .env or environment.")
+        sys.exit(1)
+
+    client = ResyClient(api_key, auth_token)
+
+    # --- Search ---
+    venue = await search_restaurant(client)
+    if not venue:
+        return
+
+    # --- Party size & date ---
+    try:
+        party_size = int((await _prompt("\nParty size: ")).strip())
+    except ValueError:
+        print("Invalid party size.")
+        return
+
+    day = (await _prompt("Date (YYYY-MM-DD): ")).strip()
+
+    # --- Find slots ---
+    try:
+        slots = await client.find_slots(venue["id"], party_size, day)
+    except Exception as e:
+        print(f"Failed to fetch time slots: {e}")
+        return
+
+    if not slots:
+        print("No available time slots.")
+        return
+
+    print("\nAvailable times:")
+    for i, slot in enumerate(slots, 1):
+        start = slot.start or "unknown"
+        print(f"  {i}. {start}  ({slot.type})")
+
+    watch_option = len(slots) + 1
+    print(f"  {watch_option}. None of these — watch for a specific time")
+
+    # --- Select slot ---
+    slot_choice = (await _prompt("\nSelect a time slot (number): ")).strip()
+    try:
+        choice_idx = int(slot_choice)
+    except ValueError:
+        print("Invalid selection.")
+        return
+
+    if choice_idx == watch_option:
+        await watch_for_cancellations(client, venue, party_size, day, quiet=quiet)
+        return
+
+    try:
+        selected_slot = slots[choice_idx - 1]
+    except IndexError:
+        print("Invalid selection.")
+        return
+
+    config_id = selected_slot.token
+    start_time = selected_slot.start or "unknown"
+
+    # --- Get booking details ---
+    try:
+        details = await client.get_details(config_id, day, party_size)
+    except Exception as e:
+        print(f"Failed to get booking details: {e}")
+        return
+
+    book_token = details["book_token"]
+    payment_method_id = details["payment_method_id"]
+
+    if not book_token:
+        print("Could not obtain a booking token.")
+        return
+
+    # --- Confirm ---
+    confirm = (await _prompt(
+        f"\nBook {venue['name']} for {party_size} on {day} at {start_time}? (y/n): "
+    )).strip().lower()
+
+    if confirm != "y":
+        print("Booking cancelled.")
+        return
+
+    # --- Book ---
+    try:
+        result = await client.book(book_token, payment_method_id)
+        resy_token = result.get("resy_token", "N/A")
+        print(f"\nReservation confirmed! Confirmation token: {resy_token}")
+        booked_iso = datetime.now().isoformat(timespec="seconds")
+        log_entry({
+            "status": "booked",
+            "venue": venue["name"],
+            "venue_id": venue["id"],
+            "date": day,
+            "time": start_time,
+            "party_size": party_size,
+            "confirmation_token": resy_token,
+            "booked_at": booked_iso,
+            "created_at": booked_iso,
+        })
+    except Exception as e:
+        print(f"\nBooking failed: {e}")
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -1,46 +1,69 @@
-"""Send messages via Twilio (SMS or WhatsApp)."""
-
-import os
-
-from twilio.rest import Client
-
-
-def send_message(body: str, to: str, channel: str = "whatsapp") -> None:
-    """Send a message via SMS or WhatsApp.
-
-    Args:
-        body: Message text.
-        to: Destination number (e.g. "+1234567890" or "whatsapp:+1234567890").
-        channel: "sms" or "whatsapp".
-    """
-    account_sid = os.getenv("TWILIO_ACCOUNT_SID")
-    auth_token = os.getenv("TWILIO_AUTH_TOKEN")
-
-    if not all([account_sid, auth_token]):
-        return
-
-    client = Client(account_sid, auth_token)
-
-    if channel == "whatsapp":
-        from_number = os.getenv("TWILIO_FROM_NUMBER")
-        if not from_number:
-            return
-        from_ = f"whatsapp:{from_number}"
-        to_ = to if to.startswith("whatsapp:") else f"whatsapp:{to}"
-    else:
-        from_number = os.getenv("TWILIO_SMS_FROM_NUMBER", os.getenv("TWILIO_FROM_NUMBER"))
-        if not from_number:
-            return
-        from_ = from_number
-        to_ = to.replace("whatsapp:", "")  # strip prefix if present
-
-    client.messages.create(body=body, from_=from_, to=to_)
-
-
-# Backwards-compatible alias
-def send_sms(body: str, to: str | None = None) -> None:
-    """Send a WhatsApp message (legacy helper)."""
-    to_number = to or os.getenv("NOTIFY_PHONE_NUMBER")
-    if not to_number:
-        return
-    send_message(body, to=to_number, channel="whatsapp")
+"""Send messages via Twilio (SMS or WhatsApp)."""
+
+import os
+import threading
+
+from twilio.rest import Client
+
+# Twilio Client owns a requests.Session, so reusing one instance keeps the
+# TLS connection to api.twilio.com alive across sends instead of paying a
+# handshake per notification. Env config is read once alongside it; the
+# app layer already offloads sends to a thread, hence the lock.
+_client: Client | None = None
+_client_lock = threading.Lock()
+_from_number: str | None = None
+_sms_from_number: str | None = None
+_notify_number: str | None = None
+
+
+def _get_client() -> Client | None:
+    global _client, _from_number, _sms_from_number, _notify_number
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                account_sid = os.getenv("TWILIO_ACCOUNT_SID")
+                auth_token = os.getenv("TWILIO_AUTH_TOKEN")
+                if not all([account_sid, auth_token]):
+                    return None
+                _from_number = os.getenv("TWILIO_FROM_NUMBER")
+                _sms_from_number = os.getenv("TWILIO_SMS_FROM_NUMBER", _from_number)
+                _notify_number = os.getenv("NOTIFY_PHONE_NUMBER")
+                _client = Client(account_sid, auth_token)
+    return _client
+
+
+def send_message(body: str, to: str, channel: str = "whatsapp") -> None:
+    """Send a message via SMS or WhatsApp.
+
+    Args:
+        body: Message text.
+        to: Destination number (e.g. "+1234567890" or "whatsapp:+1234567890").
+        channel: "sms" or "whatsapp".
+    """
+    client = _get_client()
+    if client is None:
+        return
+
+    if channel == "whatsapp":
+        if not _from_number:
+            return
+        from_ = f"whatsapp:{_from_number}"
+        to_ = to if to.startswith("whatsapp:") else f"whatsapp:{to}"
+    else:
+        if not _sms_from_number:
+            return
+        from_ = _sms_from_number
+        to_ = to.replace("whatsapp:", "")  # strip prefix if present
+
+    client.messages.create(body=body, from_=from_, to=to_)
+
+
+# Backwards-compatible alias
+def send_sms(body: str, to: str | None = None) -> None:
+    """Send a WhatsApp message (legacy helper)."""
+    if _get_client() is None:
+        return
+    to_number = to or _notify_number
+    if not to_number:
+        return
+    send_message(body, to=to_number, channel="whatsapp")